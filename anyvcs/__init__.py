@@ -91,7 +91,7 @@ def probe(path):
         raise UnknownVCSType(path)
 
 
-def open(path, vcs=None):
+def open(path, vcs=None, **kwargs):
     """Open an existing repository
 
     :param str path: The path of the repository
@@ -99,14 +99,16 @@ def open(path, vcs=None):
                 auto-detection. Either ``git``, ``hg``, or ``svn``.
     :raises UnknownVCSType: if the repository type couldn't be inferred
 
-    If ``vcs`` is not specified, it is inferred via :func:`probe`.
+    If ``vcs`` is not specified, it is inferred via :func:`probe`. Any other
+    keyword arguments, such as ``engine``, are passed on to the repository
+    class.
 
     """
     import os
     assert os.path.isdir(path), path + ' is not a directory'
     vcs = vcs or probe(path)
     cls = _get_repo_class(vcs)
-    return cls(path)
+    return cls(path, **kwargs)
 
 
 def _get_repo_class(vcs):
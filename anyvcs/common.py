@@ -27,16 +27,20 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import datetime
+import errno
 import json
 import os
 import re
 import subprocess
+import threading
 from abc import ABCMeta, abstractmethod, abstractproperty
 from functools import wraps
 from .hashdict import HashDict
 
 multislash_rx = re.compile(r'//+')
 isodate_rx = re.compile(r'(?P<year>\d{4})-?(?P<month>\d{2})-?(?P<day>\d{2})(?:\s*(?:T\s*)?(?P<hour>\d{2})(?::?(?P<minute>\d{2})(?::?(?P<second>\d{2}))?)?(?:[,.](?P<fraction>\d+))?(?:\s*(?P<tz>(?:Z|[+-](?P<tzhh>\d{2})(?::?(?P<tzmm>\d{2}))?)))?)')
+hunk_rx = re.compile(br'^@@ -\d+(?:,(?P<old>\d+))? \+\d+(?:,(?P<new>\d+))? @@')
+diff_header_rx = re.compile(br'^(?:Index|Modified|Added|Deleted|Copied|Replaced): (?P<path>.*?)(?: \(from .*\))?$')
 tz_rx = re.compile(r'^(?P<tz>(?:Z|[+-](?P<tzhh>\d{2})(?::?(?P<tzmm>\d{2}))?))$')
 
 
@@ -85,6 +89,278 @@ def command(cmd, input=None, **kwargs):
         return stdout
 
 
+class RecordReader(object):
+    """Split a byte stream into delimited records
+
+    Data is read from the file object ``f`` in chunks of up to ``bufsize``
+    bytes and split on the requested delimiter, carrying any remainder over to
+    the next chunk. The delimiter may differ from one call to the next.
+
+    """
+
+    def __init__(self, f, bufsize=65536):
+        self.read = getattr(f, 'read1', f.read)
+        self.bufsize = bufsize
+        self.buf = b''
+        self.pos = 0
+
+    def readuntil(self, stop):
+        """Read the next record
+
+        :param bytes stop: The delimiter which ends the record.
+        :returns: The record without the delimiter, or None if the stream is
+                  exhausted. The last record need not end with the delimiter.
+
+        """
+        parts = []
+        while True:
+            i = self.buf.find(stop, self.pos)
+            if i != -1:
+                parts.append(self.buf[self.pos:i])
+                self.pos = i + len(stop)
+                return b''.join(parts)
+            # keep enough of the buffer to find a delimiter split across reads
+            keep = max(self.pos, len(self.buf) - len(stop) + 1)
+            parts.append(self.buf[self.pos:keep])
+            chunk = self.read(self.bufsize)
+            if not chunk:
+                parts.append(self.buf[keep:])
+                self.buf = b''
+                self.pos = 0
+                record = b''.join(parts)
+                if record:
+                    return record
+                return None
+            self.buf = self.buf[keep:] + chunk
+            self.pos = 0
+
+    def records(self, stop):
+        """Iterate over the remaining records delimited by stop"""
+        while True:
+            record = self.readuntil(stop)
+            if record is None:
+                return
+            yield record
+
+    def chunks(self):
+        """Iterate over the remaining data in chunks of up to bufsize bytes"""
+        if self.pos < len(self.buf):
+            yield self.buf[self.pos:]
+        self.buf = b''
+        self.pos = 0
+        while True:
+            chunk = self.read(self.bufsize)
+            if not chunk:
+                return
+            yield chunk
+
+
+def command_records(cmd, stop, bufsize=65536, input=None, **kwargs):
+    """Run a command and iterate over the delimited records of its output
+
+    The output is consumed incrementally. If iteration is stopped early then
+    the command is terminated. Otherwise CalledProcessError is raised at the
+    end of iteration if the command failed.
+
+    If ``input`` is given, it is an iterable of bytes which is written to the
+    command's stdin from a separate thread while the output is read. An
+    exception raised by ``input`` is re-raised at the end of iteration.
+
+    """
+    return _command_output(
+        cmd, lambda reader: reader.records(stop), bufsize, input, kwargs)
+
+
+def command_chunks(cmd, bufsize=65536, input=None, **kwargs):
+    """Run a command and iterate over its raw output in chunks
+
+    This behaves like :func:`command_records`, but yields the output as it
+    is read instead of splitting it into records.
+
+    """
+    return _command_output(
+        cmd, lambda reader: reader.chunks(), bufsize, input, kwargs)
+
+
+def limit_chunks(chunks, max_bytes):
+    """Truncate an iterator of bytes to at most max_bytes in total
+
+    The underlying iterator is closed as soon as the limit is reached, which
+    terminates a command started by :func:`command_chunks`.
+
+    """
+    if max_bytes is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    chunks = iter(chunks)
+    try:
+        for chunk in chunks:
+            if len(chunk) >= max_bytes:
+                if max_bytes:
+                    yield chunk[:max_bytes]
+                return
+            max_bytes -= len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def iter_lines(chunks):
+    """Split an iterator of bytes into lines, keeping the line endings"""
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def iter_records(chunks, stop):
+    """Split an iterator of bytes into records delimited by stop
+
+    Like :meth:`RecordReader.records`, the last record need not end with the
+    delimiter.
+
+    """
+    rest = b''
+    for chunk in chunks:
+        records = (rest + chunk).split(stop)
+        rest = records.pop()
+        for record in records:
+            yield record
+    if rest:
+        yield rest
+
+
+def _diff_path(line):
+    # strip the a/ or b/ prefix and any trailing date or revision
+    path = line[4:].split(b'\t', 1)[0].rstrip(b'\r\n')
+    if path == b'/dev/null':
+        return None
+    if path[:2] in (b'a/', b'b/'):
+        path = path[2:]
+    return path
+
+
+def parse_diffstat(chunks, encoding='utf-8'):
+    """Count the changed lines of each file in a unified diff
+
+    :param chunks: An iterable of bytes making up the diff, which may be in
+                   the format of git, Mercurial (with ``--git``), ``svn diff``
+                   or ``svnlook diff``.
+    :param str encoding: The encoding of paths in the diff.
+    :returns: An iterator of :class:`DiffStat`, one for each file.
+
+    Only the lines within hunks are counted, so property changes and other
+    annotations are ignored.
+
+    """
+    stat = None
+    candidate = None
+    old = new = 0
+    for line in iter_lines(chunks):
+        if old or new:
+            c = line[:1]
+            if c == b'-':
+                stat[2] += 1
+                old -= 1
+            elif c == b'+':
+                stat[1] += 1
+                new -= 1
+            elif c == b' ' or line in (b'\n', b'\r\n'):
+                old -= 1
+                new -= 1
+            continue
+        m = hunk_rx.match(line)
+        if m and stat is not None:
+            old = int(m.group('old') or 1)
+            new = int(m.group('new') or 1)
+            continue
+        header = None
+        if line.startswith(b'diff --git '):
+            # a/path b/path, where both paths are the same except for renames
+            rest = line[13:].rstrip(b'\r\n')
+            n = (len(rest) - 3) // 2
+            header = rest[:n] if rest[n:n + 3] == b' b/' else rest
+        elif candidate is not None and line.startswith(b'===='):
+            header = candidate
+        candidate = None
+        if header is not None:
+            if stat is not None:
+                yield DiffStat(stat[0].decode(encoding, 'replace'), *stat[1:4])
+            stat = [header, 0, 0, False, None]
+            continue
+        m = diff_header_rx.match(line.rstrip(b'\r\n'))
+        if m:
+            # svn headers are underlined, unlike property names
+            candidate = m.group('path')
+        elif stat is None:
+            continue
+        elif line.startswith(b'--- '):
+            stat[4] = _diff_path(line)
+        elif line.startswith(b'+++ '):
+            stat[0] = _diff_path(line) or stat[4] or stat[0]
+        elif (
+            line.startswith(b'GIT binary patch') or
+            line.startswith(b'Binary file') or
+            line.startswith(b'(Binary files differ)') or
+            line.startswith(b'Cannot display: file marked as a binary type.')
+        ):
+            stat[3] = True
+    if stat is not None:
+        yield DiffStat(stat[0].decode(encoding, 'replace'), *stat[1:4])
+
+
+def _command_output(cmd, parse, bufsize, input, kwargs):
+    kwargs['stdout'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    p = subprocess.Popen(cmd, **kwargs)
+    errors = []
+    feeder = None
+    if input is not None:
+        def feed():
+            try:
+                for chunk in input:
+                    p.stdin.write(chunk)
+                    p.stdin.flush()
+            except (IOError, OSError) as e:
+                # the command went away, which is reported below
+                if e.errno != errno.EPIPE:
+                    errors.append(e)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    p.stdin.close()
+                except (IOError, OSError):
+                    pass
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+    finished = False
+    try:
+        for record in parse(RecordReader(p.stdout, bufsize)):
+            yield record
+        finished = True
+    finally:
+        p.stdout.close()
+        if not finished and p.poll() is None:
+            p.terminate()
+        p.wait()
+        if feeder is not None:
+            feeder.join()
+    if errors:
+        raise errors[0]
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
 class ABCMetaDocStringInheritor(ABCMeta):
     '''A variation on
     http://groups.google.com/group/comp.lang.python/msg/26f7b4fcb4d66c95
@@ -205,6 +481,34 @@ class CommitLogCache(HashDict):
         HashDict.__setitem__(self, key, value)
 
 
+class BlameCache(HashDict):
+    """An on-disk cache of blame results
+
+    Values are lists of ``(count, rev, author, date)`` tuples, one for each
+    run of consecutive lines attributed to the same revision. The lines
+    themselves are not stored.
+    """
+    def __getitem__(self, key):
+        value = json.loads(HashDict.__getitem__(self, key).decode())
+        if value.get('v') != 1:
+            raise KeyError(key)
+        revs = [(r, a, parse_isodate(d)) for r, a, d in value['r']]
+        return [(n,) + revs[i] for n, i in value['h']]
+
+    def __setitem__(self, key, value):
+        revs = []
+        index = {}
+        hunks = []
+        for count, rev, author, date in value:
+            k = (rev, author, date.isoformat())
+            if k not in index:
+                index[k] = len(revs)
+                revs.append(k)
+            hunks.append((count, index[k]))
+        value = json.dumps({'v': 1, 'r': revs, 'h': hunks}).encode()
+        HashDict.__setitem__(self, key, value)
+
+
 class FileChangeInfo(object):
     """Represents a change to a single path.
 
@@ -218,6 +522,25 @@ class FileChangeInfo(object):
         self.copy = copy
 
 
+class DiffStat(object):
+    """Represents the size of the change to a single file in a diff.
+
+    :ivar str path: The path that was changed.
+    :ivar int added: The number of lines added.
+    :ivar int deleted: The number of lines deleted.
+    :ivar bool binary: Whether the file is binary, in which case no lines are
+                       counted.
+    """
+    def __init__(self, path, added, deleted, binary=False):
+        self.path = path
+        self.added = added
+        self.deleted = deleted
+        self.binary = binary
+
+    def __iter__(self):
+        return iter((self.added, self.deleted, self.binary))
+
+
 class BlameInfo(object):
     """Represents an annotated line in a file for a blame view.
 
@@ -274,6 +597,21 @@ class VCSRepo(object):
         self.path = path
         self.encoding = encoding
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Release any resources held by the repository object
+
+        This stops any long-running helper processes. The repository object
+        may still be used afterwards; resources will be re-acquired on demand.
+
+        """
+        pass
+
     @abstractproperty
     def private_path(self):
         """Get the path to a directory which can be used to store arbitrary data
@@ -293,10 +631,37 @@ class VCSRepo(object):
             self._commit_cache_v = CommitLogCache(commit_cache_path)
             return self._commit_cache_v
 
+    @property
+    def _blame_cache(self):
+        try:
+            return self._blame_cache_v
+        except AttributeError:
+            blame_cache_path = os.path.join(self.private_path, 'blame-cache')
+            self._blame_cache_v = BlameCache(blame_cache_path)
+            return self._blame_cache_v
+
     def _command(self, cmd, input=None, **kwargs):
         kwargs.setdefault('cwd', self.path)
         return command(cmd, **kwargs)
 
+    def _command_records(self, cmd, stop, **kwargs):
+        kwargs.setdefault('cwd', self.path)
+        return command_records(cmd, stop, **kwargs)
+
+    def _command_chunks(self, cmd, **kwargs):
+        kwargs.setdefault('cwd', self.path)
+        return command_chunks(cmd, **kwargs)
+
+    def _write_chunks(self, chunks, out, max_bytes):
+        chunks = limit_chunks(chunks, max_bytes)
+        if out is None:
+            return chunks
+        count = 0
+        for chunk in chunks:
+            out.write(chunk)
+            count += len(chunk)
+        return count
+
     @classmethod
     def cleanPath(cls, path):
         path = path.lstrip('/')
@@ -456,7 +821,6 @@ class VCSRepo(object):
         """
         return NotImplementedError
 
-    @abstractmethod
     def log(
         self, revrange=None, limit=None, firstparent=False, merges=None,
         path=None, follow=False
@@ -485,6 +849,29 @@ class VCSRepo(object):
         beginning of history. If B is None, list all descendants in reverse
         chronological order.
 
+        """
+        entries = self.iter_log(
+            revrange, limit, firstparent, merges, path, follow)
+        if revrange is None or isinstance(revrange, (tuple, list)):
+            return list(entries)
+        for entry in entries:
+            return entry
+
+    @abstractmethod
+    def iter_log(
+        self, revrange=None, limit=None, firstparent=False, merges=None,
+        path=None, follow=False
+    ):
+        """Iterate over commit logs
+
+        This takes the same arguments as :meth:`log`, but returns an iterator
+        which produces the :class:`CommitLogEntry` objects as they are read
+        from the underlying VCS. If revrange is a single revision, the
+        iterator produces a single entry.
+
+        Work stops when the consumer stops iterating, so fetching only the
+        first few entries of a long history is cheap.
+
         """
         raise NotImplementedError
 
@@ -498,6 +885,35 @@ class VCSRepo(object):
         """
         raise NotImplementedError
 
+    def changed_many(self, revs):
+        """Files that changed in each of many revisions
+
+        :param revs: An iterable of revisions.
+        :returns: An iterator of ``(rev, changes)`` pairs, in the order of
+                  ``revs``, where ``changes`` is what :meth:`changed` would
+                  return for ``rev``.
+
+        """
+        for rev in revs:
+            yield rev, self.changed(rev)
+
+    def changed_range(
+        self, revrange=None, limit=None, firstparent=False, merges=None,
+        path=None, follow=False
+    ):
+        """Files that changed in each revision of a log
+
+        The arguments are the same as for :meth:`log`, and the result is the
+        same as for :meth:`changed_many` over the revisions that :meth:`log`
+        would return.
+
+        """
+        revs = (
+            x.rev for x in self.iter_log(
+                revrange, limit, firstparent, merges, path, follow)
+        )
+        return self.changed_many(revs)
+
     @abstractmethod
     def pdiff(self, rev):
         """Diff from the rev's parent(s)
@@ -511,6 +927,22 @@ class VCSRepo(object):
         """
         raise NotImplementedError
 
+    def pdiff_stream(self, rev, out=None, max_bytes=None):
+        """Stream the diff from the rev's parent(s)
+
+        :param rev: The rev to compute the diff from its parent.
+        :param out: An optional file-like object to write the diff to.
+        :param int max_bytes: If not None, stop after this many bytes.
+        :returns: An iterator of bytes chunks of the encoded diff, or if
+                  ``out`` is given, the number of bytes written to it.
+
+        The diff is the same as the one returned by :meth:`pdiff`, but it is
+        passed on as it is produced instead of being held in memory.
+
+        """
+        chunks = [self.pdiff(rev).encode(self.encoding)]
+        return self._write_chunks(chunks, out, max_bytes)
+
     @abstractmethod
     def diff(self, rev_a, rev_b, path=None):
         """Diff of two revisions
@@ -526,6 +958,34 @@ class VCSRepo(object):
         """
         raise NotImplementedError
 
+    def diff_stream(self, rev_a, rev_b, path=None, out=None, max_bytes=None):
+        """Stream the diff of two revisions
+
+        This takes the arguments of :meth:`diff`, and ``out`` and
+        ``max_bytes`` as for :meth:`pdiff_stream`.
+
+        """
+        chunks = [self.diff(rev_a, rev_b, path).encode(self.encoding)]
+        return self._write_chunks(chunks, out, max_bytes)
+
+    def pstat(self, rev):
+        """Count the changed lines of each file in :meth:`pdiff`
+
+        :param rev: The rev to compute the diff from its parent.
+        :returns: A list of :class:`DiffStat` objects.
+
+        """
+        return list(parse_diffstat(self.pdiff_stream(rev), self.encoding))
+
+    def diffstat(self, rev_a, rev_b, path=None):
+        """Count the changed lines of each file in :meth:`diff`
+
+        :returns: A list of :class:`DiffStat` objects.
+
+        """
+        chunks = self.diff_stream(rev_a, rev_b, path)
+        return list(parse_diffstat(chunks, self.encoding))
+
     @abstractmethod
     def ancestor(self, rev1, rev2):
         """Find most recent common ancestor of two revisions
@@ -550,6 +1010,16 @@ class VCSRepo(object):
         """
         raise NotImplementedError
 
+    def iter_blame(self, rev, path):
+        """Iterate over the annotated lines of a file
+
+        This takes the same arguments as :meth:`blame`, but returns an
+        iterator of :class:`BlameInfo` objects in line order, which may
+        produce the first lines before the whole file has been blamed.
+
+        """
+        return iter(self.blame(rev, path))
+
     @abstractmethod
     def tip(self, head):
         """Find the tip of a named head
@@ -26,26 +26,669 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
+import collections
+import fcntl
+import hashlib
 import os
 import re
 import stat
+import struct
 import subprocess
+import sys
+import threading
+import time
 from .common import *
 from .hashdict import HashDict
+from .pathindex import PathIndex
 
 GIT = 'git'
+GIT_OBJECT_TYPES = (b'blob', b'tree', b'commit', b'tag')
 
 rev_rx = re.compile(r'^[0-9a-f]{40}$', re.IGNORECASE)
 branch_rx = re.compile(r'^[*]?\s+(?P<name>.+)$')
 
 
-def readuntil(f, stop):
-    buf = bytes()
-    while True:
-        b = f.read(1)
-        if b == stop or not b:
-            return buf
-        buf += b
+GitObject = collections.namedtuple('GitObject', 'sha type size data')
+
+
+def _git_dir(path):
+    """Find the git directory of a bare repository or a working tree
+
+    Only the file system is consulted. A working tree's ``.git`` may be the
+    directory itself or a ``gitdir:`` file pointing to it.
+
+    """
+    dotgit = os.path.join(path, '.git')
+    if os.path.isdir(dotgit):
+        return dotgit
+    if os.path.isfile(dotgit):
+        try:
+            with open(dotgit) as f:
+                line = f.readline()
+        except IOError:
+            return path
+        if line.startswith('gitdir: '):
+            return os.path.normpath(os.path.join(path, line[8:].strip()))
+    return path
+
+
+def iter_tree(data):
+    """Parse the contents of a tree object
+
+    Yields a ``(mode, name, sha)`` tuple for each entry, where ``mode`` is an
+    int, ``name`` is bytes, and ``sha`` is a hex string.
+
+    """
+    i = 0
+    n = len(data)
+    while i < n:
+        sp = data.index(b' ', i)
+        nul = data.index(b'\0', sp)
+        mode = int(data[i:sp], 8)
+        name = data[sp + 1:nul]
+        sha = binascii.hexlify(data[nul + 1:nul + 21]).decode()
+        yield mode, name, sha
+        i = nul + 21
+
+
+class GitCatFile(object):
+    """A long-running ``git cat-file --batch`` process.
+
+    Objects are requested by writing their names to the process' stdin, so
+    each lookup costs a pipe round-trip instead of a fork and exec. The
+    process is started on first use and restarted if it dies.
+
+    If ``check`` is True then ``--batch-check`` is used and only the object
+    type and size are returned.
+
+    """
+
+    def __init__(self, path, check=False):
+        self.path = path
+        self.check = check
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        cmd = [GIT, 'cat-file', '--batch-check' if self.check else '--batch']
+        self.process = subprocess.Popen(
+            cmd, cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    def _stop(self):
+        p = self.process
+        self.process = None
+        if p is None:
+            return
+        for f in (p.stdin, p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        if p.poll() is None:
+            p.terminate()
+        p.wait()
+
+    def close(self):
+        with self.lock:
+            self._stop()
+
+    def _request(self, name):
+        p = self.process
+        p.stdin.write(name + b'\n')
+        p.stdin.flush()
+        header = p.stdout.readline()
+        if not header.endswith(b'\n'):
+            raise IOError('git cat-file exited unexpectedly')
+        header = header[:-1]
+        if header.endswith(b' missing') or header.endswith(b' ambiguous'):
+            return None
+        fields = header.split(b' ')
+        if (len(fields) != 3 or fields[1] not in GIT_OBJECT_TYPES or
+                not fields[2].isdigit()):
+            # the stream can not be trusted any more
+            self._stop()
+            raise ValueError('unexpected git cat-file output: %r' % header)
+        sha, type, size = fields
+        size = int(size)
+        data = None
+        if not self.check:
+            data = p.stdout.read(size + 1)
+            if len(data) != size + 1:
+                raise IOError('git cat-file exited unexpectedly')
+            data = data[:-1]
+        return GitObject(sha.decode(), type.decode(), size, data)
+
+    def __call__(self, name):
+        """Look up an object by name
+
+        :param bytes name: Any object name understood by git, e.g.
+                           ``<rev>:<path>``. Must not contain a newline.
+        :returns: a :class:`GitObject`, or None if the object does not exist.
+
+        """
+        assert b'\n' not in name, 'object names may not contain newlines'
+        with self.lock:
+            try:
+                if self.process is None:
+                    self._start()
+                return self._request(name)
+            except (IOError, OSError):
+                # the process died, so try once more with a new process
+                self._stop()
+                self._start()
+                try:
+                    return self._request(name)
+                except (IOError, OSError):
+                    self._stop()
+                    raise
+
+
+class GitRefs(object):
+    """Read the ref database directly from the repository
+
+    Loose refs under ``refs/``, ``packed-refs`` and ``HEAD`` are parsed in
+    Python and cached. The cache is thrown away whenever the modification
+    time of ``HEAD``, ``packed-refs`` or anything under ``refs/`` changes.
+
+    ``path`` is the git directory, i.e. ``.git`` in a working tree. Ref names
+    are bytes. Layouts this class does not understand (reftable, linked
+    worktrees) are reported by :attr:`supported` being False, in which case
+    callers should ask git.
+
+    """
+
+    symref_prefix = b'ref: '
+    rev_prefixes = (
+        b'', b'refs/', b'refs/tags/', b'refs/heads/', b'refs/remotes/'
+    )
+    special_rx = re.compile(br'[\x00-\x20\x7f~^:?*\[\\{}@]|\.\.|^-|//')
+
+    def __init__(self, path):
+        self.path = path
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        self._bpath = path
+        self.lock = threading.Lock()
+        self._key = None
+        self._quick = None
+        self._refs = {}
+        self._peeled = {}
+
+    @property
+    def supported(self):
+        return (
+            os.path.isfile(os.path.join(self.path, 'HEAD')) and
+            os.path.isdir(os.path.join(self.path, 'refs')) and
+            not os.path.exists(os.path.join(self.path, 'reftable')) and
+            not os.path.exists(os.path.join(self.path, 'commondir'))
+        )
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_ino, st.st_size)
+
+    def fingerprint(self):
+        """Get a value which changes whenever any ref changes
+
+        It is made from the inode, size and modification time of ``HEAD``,
+        ``packed-refs`` and everything under ``refs/``.
+
+        Loose refs are replaced by renaming, which also changes the
+        modification time of their directory. So if ``HEAD``,
+        ``packed-refs`` and the directories are unchanged, the previous
+        fingerprint is reused without looking at every ref.
+
+        """
+        path = self._bpath
+        top = [
+            self._stat(os.path.join(path, b'HEAD')),
+            self._stat(os.path.join(path, b'packed-refs')),
+        ]
+        quick = self._quick
+        if quick is not None:
+            dirs, stats, key = quick
+            if top + [self._stat(x) for x in dirs] == stats:
+                return key
+        start = time.time()
+        key = list(top)
+        dirs = []
+        stats = list(top)
+        for dirpath, dirnames, filenames in os.walk(os.path.join(path, b'refs')):
+            dirnames.sort()
+            st = self._stat(dirpath)
+            dirs.append(dirpath)
+            stats.append(st)
+            key.append((dirpath, st))
+            for name in sorted(filenames):
+                p = os.path.join(dirpath, name)
+                key.append((p, self._stat(p)))
+        # a change in the same second as the walk might not be visible in
+        # the modification times, so such a walk can not be reused
+        if all(x is None or x[0] < start - 1 for x in stats):
+            self._quick = dirs, stats, key
+        else:
+            self._quick = None
+        return key
+
+    def _load(self):
+        path = self._bpath
+        refs = {}
+        peeled = {}
+        try:
+            with open(os.path.join(path, b'packed-refs'), 'rb') as f:
+                last = None
+                for line in f:
+                    line = line.rstrip(b'\n')
+                    if not line or line.startswith(b'#'):
+                        continue
+                    if line.startswith(b'^'):
+                        if last is not None:
+                            peeled[last] = line[1:].decode()
+                        continue
+                    sha, last = line.split(b' ', 1)
+                    refs[last] = sha.decode()
+        except IOError:
+            pass
+        loose = [(b'HEAD', os.path.join(path, b'HEAD'))]
+        for dirpath, dirnames, filenames in os.walk(os.path.join(path, b'refs')):
+            for name in filenames:
+                if name.endswith(b'.lock'):
+                    continue
+                p = os.path.join(dirpath, name)
+                loose.append((os.path.relpath(p, path).replace(os.sep.encode(), b'/'), p))
+        for name, p in loose:
+            try:
+                with open(p, 'rb') as f:
+                    value = f.read().strip()
+            except IOError:
+                continue
+            if value.startswith(self.symref_prefix):
+                refs[name] = value
+                peeled.pop(name, None)
+            elif rev_rx.match(value.decode('ascii', 'replace')):
+                refs[name] = value.decode()
+                peeled.pop(name, None)
+        return refs, peeled
+
+    def _refresh(self):
+        key = self.fingerprint()
+        with self.lock:
+            if key != self._key:
+                self._refs, self._peeled = self._load()
+                self._key = key
+            return self._refs, self._peeled
+
+    def _follow(self, refs, name):
+        for i in range(5):
+            value = refs.get(name)
+            if not isinstance(value, bytes):
+                return value
+            name = value[len(self.symref_prefix):]
+        return None
+
+    def names(self, prefix):
+        """Get the names of the refs under ``prefix``, with ``prefix`` removed
+
+        The names are sorted in the same order git uses.
+
+        """
+        refs, peeled = self._refresh()
+        results = []
+        for name in refs:
+            if name.startswith(prefix) and self._follow(refs, name):
+                results.append(name[len(prefix):])
+        results.sort()
+        return results
+
+    def resolve(self, name):
+        """Resolve a symbolic name to a sha
+
+        ``name`` is looked up using the same rules as ``git rev-parse``. Tags
+        are not peeled, so an annotated tag resolves to the tag object.
+
+        :returns: a hex string, or None if ``name`` is not a plain ref name
+                  or no such ref exists.
+
+        """
+        if not name or self.special_rx.search(name):
+            return None
+        refs, peeled = self._refresh()
+        for prefix in self.rev_prefixes:
+            ref = prefix + name
+            if not prefix and ref != b'HEAD' and not ref.startswith(b'refs/'):
+                continue
+            sha = self._follow(refs, ref)
+            if sha:
+                return sha
+        return self._follow(refs, b'refs/remotes/' + name + b'/HEAD')
+
+    def peel(self, name):
+        """Get the commit a packed tag points to, if git recorded it
+
+        :returns: a hex string, or None if it is not known.
+
+        """
+        refs, peeled = self._refresh()
+        return peeled.get(name)
+
+
+class GitNativeCatFile(object):
+    """Answer :class:`GitCatFile` lookups without running git
+
+    Objects are read through an :class:`~anyvcs.gitstore.ObjectStore`. Names
+    of the form ``<rev>``, ``<rev>^{commit}`` and ``<rev>:<path>`` are
+    understood when ``<rev>`` is a sha or a plain ref name. Anything else,
+    and any object the store can not read, is passed on to ``fallback``.
+
+    """
+
+    def __init__(self, store, refs, fallback):
+        self.store = store
+        self.refs = refs
+        self.check = fallback.check
+        self.fallback = fallback
+
+    def close(self):
+        self.fallback.close()
+
+    def _resolve(self, rev):
+        if rev_rx.match(rev.decode('ascii', 'replace')):
+            return rev.decode('ascii').lower()
+        if self.refs.supported:
+            return self.refs.resolve(rev)
+        return None
+
+    def _read(self, sha, header_only=False):
+        result = self.store.read(sha, header_only)
+        if result is None:
+            raise KeyError(sha)
+        return result
+
+    def _peel(self, sha, type):
+        while True:
+            t, size, data = self._read(sha)
+            if t == type:
+                return sha, data
+            if t == 'tag':
+                sha = data[7:47].decode()
+            elif t == 'commit' and type == 'tree':
+                sha = data[5:45].decode()
+            else:
+                return None, None
+
+    def _lookup(self, name):
+        rev, sep, path = name.partition(b':')
+        peel = rev.endswith(b'^{commit}')
+        if peel:
+            rev = rev[:-len(b'^{commit}')]
+        sha = self._resolve(rev)
+        if not sha or (sep and peel):
+            raise KeyError(name)
+        if peel:
+            sha, data = self._peel(sha, 'commit')
+        elif sep:
+            sha, data = self._peel(sha, 'tree')
+            for part in [x for x in path.split(b'/') if x]:
+                if data is None:
+                    return None
+                for mode, ename, esha in iter_tree(data):
+                    if ename == part:
+                        break
+                else:
+                    return None
+                sha = esha
+                data = None
+                if stat.S_ISDIR(mode):
+                    data = self._read(sha)[2]
+        if sha is None:
+            return None
+        type, size, data = self._read(sha, self.check)
+        return GitObject(sha, type, size, data)
+
+    def __call__(self, name):
+        """Look up an object by name, see :meth:`GitCatFile.__call__`"""
+        try:
+            return self._lookup(name)
+        except KeyError:
+            return self.fallback(name)
+
+
+def _iter_name_only(records):
+    """Parse the output of ``git log -z --name-only --format=%x00%H %P``
+
+    :param records: The NUL-delimited records of the output.
+
+    Yields a ``(sha, parents, paths)`` tuple for each commit.
+
+    """
+    shas = None
+    header = False
+    for record in records:
+        if header:
+            shas = record.decode().split()
+            paths = []
+            header = False
+        elif record:
+            # the list of paths is preceded by a newline
+            if not paths and record.startswith(b'\n'):
+                record = record[1:]
+            paths.append(record)
+        else:
+            if shas is not None:
+                yield shas[0], shas[1:], paths
+            header = True
+    if shas is not None:
+        yield shas[0], shas[1:], paths
+
+
+def _iter_raw(records, encoding):
+    """Parse the output of ``git diff-tree -z`` without patches
+
+    :param records: The NUL-delimited records of the output.
+
+    Yields a :class:`FileChangeInfo` for each changed path.
+
+    """
+    records = iter(records)
+    for meta in records:
+        yield _parse_raw(meta, records, encoding)
+
+
+def _parse_raw(meta, records, encoding):
+    """Parse one change, reading its paths from the records iterator"""
+    status = meta.split()[4].decode()[0]
+    src_path = next(records).decode(encoding, 'replace')
+    if status in 'CR':
+        dst_path = next(records).decode(encoding, 'replace')
+        return FileChangeInfo(dst_path, str(status), src_path)
+    else:
+        return FileChangeInfo(src_path, str(status))
+
+
+def _skip_depth(depth):
+    """Depth of the skip pointer for a commit at the given depth
+
+    This is the skip list layout used by Bitcoin's block index, which allows
+    reaching any ancestor in O(log n) steps.
+
+    """
+    if depth < 2:
+        return 0
+    if depth & 1:
+        n = depth - 1
+        n &= n - 1
+        return (n & (n - 1)) + 1
+    return depth & (depth - 1)
+
+
+class LastCommitIndex(object):
+    """Incremental on-disk index of the paths changed by each commit
+
+    For each indexed commit, its first parent, its depth along the
+    first-parent chain and a skip pointer to a further ancestor are recorded.
+    Each changed path and its parent directories are mapped to the commits
+    that touched them, where a commit's changes are taken against its first
+    parent. This is enough to find the last commit that touched a path as of a
+    given revision without walking history.
+
+    Commits are indexed the first time they are needed, and a commit is never
+    indexed before its first parent.
+
+    """
+
+    flush_interval = 1000
+
+    def __init__(self, repo):
+        self.repo = repo
+        private_path = repo.private_path
+        self.commits = HashDict(os.path.join(private_path, 'first-parent-cache'))
+        self.paths = PathIndex(os.path.join(private_path, 'path-commits'), 24)
+        self.lock_path = os.path.join(private_path, 'path-commits.lock')
+
+    def _record(self, sha, memo):
+        try:
+            return memo[sha]
+        except KeyError:
+            parent, depth, skip = self.commits[sha].decode().split()
+            record = (
+                None if parent == '-' else parent,
+                int(depth),
+                None if skip == '-' else skip,
+            )
+            memo[sha] = record
+            return record
+
+    def ancestor(self, sha, depth, memo):
+        """Find the first-parent ancestor of an indexed commit at a depth"""
+        parent, walk_depth, skip = self._record(sha, memo)
+        if depth > walk_depth:
+            return None
+        while walk_depth > depth:
+            skip_depth = _skip_depth(walk_depth)
+            skip_depth_prev = _skip_depth(walk_depth - 1)
+            if skip is not None and (
+                skip_depth == depth or (
+                    skip_depth > depth and not (
+                        skip_depth_prev < skip_depth - 2 and
+                        skip_depth_prev >= depth
+                    )
+                )
+            ):
+                sha, walk_depth = skip, skip_depth
+            else:
+                sha, walk_depth = parent, walk_depth - 1
+            parent, _, skip = self._record(sha, memo)
+        return sha
+
+    def update(self, commit):
+        """Index commit and any of its first-parent ancestors not yet indexed"""
+        if commit in self.commits:
+            return
+        with open(self.lock_path, 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            if commit in self.commits:
+                return
+            self._update(commit)
+
+    def _update(self, commit):
+        memo = {}
+
+        # find the youngest first-parent ancestor which is already indexed
+        cmd = [GIT, 'rev-list', '--first-parent', commit]
+        base = None
+        shas = self.repo._command_records(cmd, b'\n')
+        try:
+            for sha in shas:
+                sha = sha.decode()
+                if sha in self.commits:
+                    base = sha
+                    break
+        finally:
+            shas.close()
+
+        cmd = [
+            GIT, 'log', '--reverse', '--first-parent', '-m', '--name-only',
+            '-z', '--format=%x00%H %P', commit,
+        ]
+        if base is None:
+            base_depth = -1
+        else:
+            base_depth = self._record(base, memo)[1]
+            cmd.append('^' + base)
+
+        # first-parent chain of the commits being indexed, in depth order
+        chain = bytearray()
+        pending = []
+        postings = {}
+        records = self.repo._command_records(cmd, b'\0')
+        try:
+            for sha, parents, paths in _iter_name_only(records):
+                raw = binascii.unhexlify(sha)
+                depth = base_depth + len(chain) // 20 + 1
+                skip_depth = _skip_depth(depth)
+                if depth == 0:
+                    skip = '-'
+                elif skip_depth > base_depth:
+                    i = (skip_depth - base_depth - 1) * 20
+                    skip = binascii.hexlify(chain[i:i + 20]).decode()
+                else:
+                    skip = self.ancestor(base, skip_depth, memo)
+                chain += raw
+                parent = parents[0] if parents else '-'
+                pending.append((sha, '%s %d %s' % (parent, depth, skip)))
+                posting = raw + struct.pack('>I', depth)
+                names = set()
+                for name in paths:
+                    names.add(name)
+                    d = name.rfind(b'/')
+                    while d != -1:
+                        name = name[:d]
+                        names.add(name)
+                        d = name.rfind(b'/')
+                for name in names:
+                    postings.setdefault(name, []).append(posting)
+                if len(pending) >= self.flush_interval:
+                    self._flush(pending, postings)
+            self._flush(pending, postings)
+        finally:
+            records.close()
+
+    def _flush(self, pending, postings):
+        # Write the path postings before the commit records, so that a commit
+        # is not considered indexed until its postings are in place.
+        self.paths.extend(postings)
+        postings.clear()
+        for sha, record in pending:
+            self.commits[sha] = record.encode()
+        del pending[:]
+
+    def lookup(self, commit, paths):
+        """Find the last commits that touched paths
+
+        :param str commit: The commit id to start from.
+        :param paths: The paths to look up, as bytes.
+        :returns: A dictionary from path to commit id.
+
+        """
+        self.update(commit)
+        memo = {}
+        depth = self._record(commit, memo)[1]
+        results = {}
+        for path in paths:
+            for posting in self.paths.reversed(path):
+                d, = struct.unpack('>I', posting[20:])
+                if d > depth:
+                    continue
+                sha = binascii.hexlify(posting[:20]).decode()
+                if self.ancestor(commit, d, memo) == sha:
+                    results[path] = sha
+                    break
+        return results
 
 
 class GitRepo(VCSRepo):
@@ -53,8 +696,43 @@ class GitRepo(VCSRepo):
 
     Valid revisions are anything that git considers as a revision.
 
+    ``engine`` selects how objects are read. ``'subprocess'`` (the default)
+    asks long-running ``git cat-file`` processes, while ``'native'`` reads
+    loose objects and packfiles directly and only falls back to git for
+    what it can not handle.
+
     """
 
+    engines = ('subprocess', 'native')
+
+    def __init__(self, path, encoding='utf-8', engine='subprocess'):
+        super(GitRepo, self).__init__(path, encoding)
+        if engine not in self.engines:
+            raise ValueError('unknown engine: ' + str(engine))
+        self.engine = engine
+        self._git_dir = _git_dir(path)
+        self._refs = GitRefs(self._git_dir)
+        self._cat_file = GitCatFile(path)
+        self._cat_file_check = GitCatFile(path, check=True)
+        self._store = None
+        if engine == 'native':
+            from .gitstore import ObjectStore
+            self._store = ObjectStore(self._git_dir)
+            self._cat_file = GitNativeCatFile(
+                self._store, self._refs, self._cat_file)
+            self._cat_file_check = GitNativeCatFile(
+                self._store, self._refs, self._cat_file_check)
+
+    def close(self):
+        self._cat_file.close()
+        self._cat_file_check.close()
+        if self._store is not None:
+            self._store.close()
+        for graph in getattr(self, '_commit_graphs_v', ()):
+            if graph is not None:
+                graph.close()
+        self.__dict__.pop('_commit_graphs_v', None)
+
     @classmethod
     def clone(cls, srcpath, destpath, encoding='utf-8'):
         """Clone an existing repository to a new bare repository."""
@@ -86,13 +764,109 @@ class GitRepo(VCSRepo):
                 raise
         return path
 
+    @property
+    def _last_commit_index(self):
+        try:
+            return self._last_commit_index_v
+        except AttributeError:
+            self._last_commit_index_v = LastCommitIndex(self)
+            return self._last_commit_index_v
+
+    @property
+    def _commit_graphs(self):
+        """git's own commit-graph file and the private one, or None"""
+        try:
+            return self._commit_graphs_v
+        except AttributeError:
+            path = os.path.join(
+                self._git_dir, 'objects', 'info', 'commit-graph')
+            private = os.path.join(self.private_path, 'commit-graph')
+            self._commit_graphs_v = [
+                self._load_commit_graph(path),
+                self._load_commit_graph(private),
+            ]
+            self._commit_graph_key = None
+            return self._commit_graphs_v
+
+    def _load_commit_graph(self, path):
+        from .gitgraph import CommitGraph
+        try:
+            return CommitGraph(path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _find_in_graph(self, revs):
+        for graph in self._commit_graphs:
+            if graph is None:
+                continue
+            positions = [graph.find(x) for x in revs]
+            if None not in positions:
+                return graph, positions
+        return None, None
+
+    def _commit_graph(self, revs):
+        """Find a commit graph which contains all the given commits
+
+        git's own ``objects/info/commit-graph`` is used if it covers the
+        commits, otherwise a graph of all commits reachable from any ref is
+        kept under :attr:`private_path`. It is rebuilt when it is missing a
+        commit and the refs have changed since it was written.
+
+        :param revs: A list of commit shas.
+        :returns: ``(graph, positions)``, or ``(None, None)`` if some of the
+                  revisions are not in any graph.
+
+        """
+        graph, positions = self._find_in_graph(revs)
+        if graph is not None:
+            return graph, positions
+        # without a fingerprint of the refs, the graph is always rebuilt
+        key = None
+        if self._refs.supported:
+            key = self._refs.fingerprint()
+            if key == self._commit_graph_key:
+                return None, None
+        from .gitgraph import write_commit_graph
+        private = os.path.join(self.private_path, 'commit-graph')
+        cmd = [
+            GIT, 'rev-list', '--all', '--parents', '--topo-order', '--reverse',
+            '--timestamp'
+        ]
+        commits = (
+            (x[1], x[2:], int(x[0]))
+            for x in (
+                y.decode().split()
+                for y in self._command_records(cmd, b'\n')
+            )
+        )
+        write_commit_graph(private, commits)
+        self._commit_graph_key = key
+        graphs = self._commit_graphs
+        if graphs[1] is not None:
+            graphs[1].close()
+        graphs[1] = self._load_commit_graph(private)
+        return self._find_in_graph(revs)
+
+    def _commit_sha(self, rev):
+        """Resolve a revision to the sha of a commit, as far as possible"""
+        rev = self.canonical_rev(rev)
+        if self._find_in_graph([rev])[0] is not None:
+            return rev
+        obj = self._cat_file_check((rev + '^{commit}').encode())
+        if obj is None:
+            return rev
+        return obj.sha
+
     def canonical_rev(self, rev):
         rev = str(rev)
         if rev_rx.match(rev):
             return rev
-        else:
-            cmd = [GIT, 'rev-parse', rev]
-            return self._command(cmd).decode().rstrip()
+        if self._refs.supported:
+            sha = self._refs.resolve(rev.encode(self.encoding))
+            if sha:
+                return sha
+        cmd = [GIT, 'rev-parse', rev]
+        return self._command(cmd).decode().rstrip()
 
     def compose_rev(self, branch, rev):
         return self.canonical_rev(rev)
@@ -117,42 +891,37 @@ class GitRepo(VCSRepo):
                     entry.commit = rev
                 return [entry]
         else:
-            epath = path.rstrip('/').encode(self.encoding)
-            cmd = [GIT, 'ls-tree', '-z', rev, '--', epath]
-            output = self._command(cmd)
-            if not output:
-                raise PathDoesNotExist(rev, path)
-            meta, ename = output.split(b'\t', 1)
-            meta = meta.decode().split()
-            if meta[1] == 'tree':
+            if self._store is not None:
+                isdir = self.stat(rev, path).type == 'd'
+            else:
+                epath = path.rstrip('/').encode(self.encoding)
+                cmd = [GIT, 'ls-tree', '-z', rev, '--', epath]
+                output = self._command(cmd)
+                if not output:
+                    raise PathDoesNotExist(rev, path)
+                meta, ename = output.split(b'\t', 1)
+                isdir = meta.decode().split()[1] == 'tree'
+            if isdir:
                 if not (directory or path.endswith('/')):
                     path = path + '/'
             elif forcedir:
                 raise PathDoesNotExist(rev, path)
 
-        cmd = [GIT, 'ls-tree', '-z']
-        if recursive:
-            cmd.append('-r')
-            if recursive_dirs:
-                cmd.append('-t')
-        if 'size' in report:
-            cmd.append('-l')
+        if self._store is not None:
+            ls_tree = self._ls_tree_native
+        else:
+            ls_tree = self._ls_tree
         epath = path.encode(self.encoding)
-        cmd.extend([rev, '--', epath])
-        output = self._command(cmd).rstrip(b'\0')
-        if not output:
-            return []
+        entries = ls_tree(
+            rev, epath, recursive, recursive_dirs, 'size' in report)
 
         results = []
         files = {}
-        for line in output.split(b'\0'):
-            meta, ename = line.split(b'\t', 1)
-            meta = meta.decode().split()
-            mode = int(meta[0], 8)
+        for mode, ename, size in entries:
             name = ename.decode(self.encoding, 'replace')
             if recursive_dirs and path == name + '/':
                 continue
-            assert name.startswith(path), 'unexpected output: ' + str(line)
+            assert name.startswith(path), 'unexpected output: ' + str(ename)
             entry = attrdict(path=name)
             entry_name = name[ltrim:].lstrip('/')
             if entry_name:
@@ -164,63 +933,194 @@ class GitRepo(VCSRepo):
                 if 'executable' in report:
                     entry.executable = bool(mode & stat.S_IXUSR)
                 if 'size' in report:
-                    entry.size = int(meta[3])
+                    entry.size = size
             elif stat.S_ISLNK(mode):
                 entry.type = 'l'
                 if 'target' in report:
                     entry.target = self._cat(rev, ename).decode(self.encoding, 'replace')
             else:
-                assert False, 'unexpected output: ' + str(line)
+                assert False, 'unexpected output: ' + str(ename)
             results.append(entry)
             files[ename] = entry
 
         if 'commit' in report:
-            cmd = [GIT, 'log', '--pretty=format:%H', '--name-only', '-m', '--first-parent', '-z', rev]
-            p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE)
-            commit = readuntil(p.stdout, b'\n').rstrip().split(b'\0')[-1]
-            while commit and files:
-                while True:
-                    f = readuntil(p.stdout, b'\0')
-                    if f == b'':
-                        commit = readuntil(p.stdout, b'\n').split(b'\0')[-1]
-                        break
-                    if not recursive:
-                        d = f[len(path):].find(b'/')
-                        if d != -1:
-                            f = f[:len(path) + d]
-                    if f in files:
-                        files[f].commit = commit.decode()
-                        del files[f]
-            p.stdout.close()
-            p.terminate()
-            p.wait()
+            commit = self._cat_file_check((rev + '^{commit}').encode()).sha
+            last = self._last_commit_index.lookup(commit, list(files))
+            for ename, entry in files.items():
+                if ename in last:
+                    entry.commit = last[ename]
 
         return results
 
+    def _ls_tree(self, rev, epath, recursive, recursive_dirs, size):
+        """Yield ``(mode, name, size)`` for each line of ``git ls-tree``"""
+        cmd = [GIT, 'ls-tree', '-z']
+        if recursive:
+            cmd.append('-r')
+            if recursive_dirs:
+                cmd.append('-t')
+        if size:
+            cmd.append('-l')
+        cmd.extend([rev, '--', epath])
+        for line in self._command_records(cmd, b'\0'):
+            meta, ename = line.split(b'\t', 1)
+            meta = meta.decode().split()
+            mode = int(meta[0], 8)
+            if size and stat.S_ISREG(mode):
+                yield mode, ename, int(meta[3])
+            else:
+                yield mode, ename, None
+
+    def _ls_tree_native(self, rev, epath, recursive, recursive_dirs, size):
+        """Like :meth:`_ls_tree`, but walk the tree objects directly"""
+        def walk(tree, prefix):
+            data = self._cat_file(tree.encode()).data
+            for mode, name, sha in iter_tree(data):
+                name = prefix + name
+                if stat.S_ISDIR(mode) and recursive:
+                    if recursive_dirs:
+                        yield mode, name, None
+                    for x in walk(sha, name + b'/'):
+                        yield x
+                elif size and stat.S_ISREG(mode):
+                    yield mode, name, self._cat_file_check(sha.encode()).size
+                else:
+                    yield mode, name, None
+
+        erev = rev.encode()
+        if not epath or epath.endswith(b'/'):
+            tree = self._cat_file_check(erev + b':' + epath.rstrip(b'/'))
+            if recursive_dirs and epath:
+                yield stat.S_IFDIR, epath.rstrip(b'/'), None
+            for x in walk(tree.sha, epath):
+                yield x
+            return
+        if b'/' in epath:
+            parent, name = epath.rsplit(b'/', 1)
+        else:
+            parent, name = b'', epath
+        tree = self._cat_file(erev + b':' + parent)
+        for mode, ename, sha in iter_tree(tree.data):
+            if ename == name:
+                break
+        else:
+            return
+        if stat.S_ISDIR(mode) and recursive:
+            if recursive_dirs:
+                yield mode, epath, None
+            for x in walk(sha, epath + b'/'):
+                yield x
+        elif size and stat.S_ISREG(mode):
+            yield mode, epath, self._cat_file_check(sha.encode()).size
+        else:
+            yield mode, epath, None
+
+    def stat(self, rev, path):
+        """Get the type, size and object id of a path
+
+        :param rev: The revision to use.
+        :param str path: The path to look up.
+        :returns: A dictionary like the ones returned by :meth:`ls` with
+                  ``directory=True``, with the additional key **object** which
+                  is the id of the git object at the path. Files and symlinks
+                  also have **size**, and files have **executable**.
+        :raises PathDoesNotExist: if the path does not exist.
+
+        The lookup is answered by long-running ``git cat-file`` processes, so
+        no new process is started.
+
+        """
+        rev = str(rev)
+        path = type(self).cleanPath(path)
+        forcedir = path.endswith('/')
+        path = path.rstrip('/')
+        epath = path.encode(self.encoding)
+        erev = rev.encode(self.encoding)
+        if b'\n' in epath or b'\n' in erev:
+            return self._stat_ls_tree(rev, path, forcedir)
+
+        obj = self._cat_file_check(erev + b':' + epath)
+        if obj is None:
+            raise PathDoesNotExist(rev, path)
+        entry = attrdict(path=path or '/', object=obj.sha)
+        if obj.type == 'tree':
+            entry.type = 'd'
+            return entry
+        if forcedir or obj.type != 'blob':
+            raise PathDoesNotExist(rev, path)
+
+        # the mode is only recorded in the parent tree
+        if b'/' in epath:
+            parent, name = epath.rsplit(b'/', 1)
+        else:
+            parent, name = b'', epath
+        tree = self._cat_file(erev + b':' + parent)
+        for mode, ename, sha in iter_tree(tree.data):
+            if ename == name:
+                break
+        else:
+            raise PathDoesNotExist(rev, path)
+        if stat.S_ISLNK(mode):
+            entry.type = 'l'
+        else:
+            entry.type = 'f'
+            entry.executable = bool(mode & stat.S_IXUSR)
+        entry.size = obj.size
+        return entry
+
+    def _stat_ls_tree(self, rev, path, forcedir):
+        epath = path.encode(self.encoding)
+        cmd = [GIT, 'ls-tree', '-z', '-l', rev, '--', epath]
+        output = self._command(cmd)
+        if not output:
+            raise PathDoesNotExist(rev, path)
+        meta, ename = output.split(b'\t', 1)
+        meta = meta.decode().split()
+        mode = int(meta[0], 8)
+        entry = attrdict(path=path, object=meta[2])
+        if stat.S_ISDIR(mode):
+            entry.type = 'd'
+            return entry
+        if forcedir:
+            raise PathDoesNotExist(rev, path)
+        if stat.S_ISLNK(mode):
+            entry.type = 'l'
+        else:
+            entry.type = 'f'
+            entry.executable = bool(mode & stat.S_IXUSR)
+        entry.size = int(meta[3])
+        return entry
+
     def _cat(self, rev, path):
         rp = rev.encode('ascii') + b':' + path
+        if b'\n' not in rp:
+            obj = self._cat_file(rp)
+            if obj is not None and obj.type == 'blob':
+                return obj.data
+        # let git report the error
         cmd = [GIT, 'cat-file', 'blob', rp]
         return self._command(cmd)
 
     def cat(self, rev, path):
         path = type(self).cleanPath(path)
-        ls = self.ls(rev, path, directory=True)
-        assert len(ls) == 1
-        if ls[0].get('type') != 'f':
+        if self.stat(rev, path).type != 'f':
             raise BadFileType(rev, path)
         epath = path.encode(self.encoding, 'strict')
-        return self._cat(rev, epath)
+        return self._cat(str(rev), epath)
 
     def readlink(self, rev, path):
         path = type(self).cleanPath(path)
-        ls = self.ls(rev, path, directory=True)
-        assert len(ls) == 1
-        if ls[0].get('type') != 'l':
+        if self.stat(rev, path).type != 'l':
             raise BadFileType(rev, path)
         epath = path.encode(self.encoding, 'strict')
-        return self._cat(rev, epath).decode(self.encoding, 'replace')
+        return self._cat(str(rev), epath).decode(self.encoding, 'replace')
 
     def branches(self):
+        if self._refs.supported:
+            return [
+                x.decode(self.encoding, 'replace')
+                for x in self._refs.names(b'refs/heads/')
+            ]
         cmd = [GIT, 'branch']
         output = self._command(cmd).decode(self.encoding, 'replace')
         results = []
@@ -231,6 +1131,11 @@ class GitRepo(VCSRepo):
         return results
 
     def tags(self):
+        if self._refs.supported:
+            return [
+                x.decode(self.encoding, 'replace')
+                for x in self._refs.names(b'refs/tags/')
+            ]
         cmd = [GIT, 'tag']
         output = self._command(cmd).decode(self.encoding, 'replace')
         return output.splitlines()
@@ -247,6 +1152,14 @@ class GitRepo(VCSRepo):
         return not rev_rx.match(stdout.decode())
 
     def __contains__(self, rev):
+        sha = None
+        if rev_rx.match(rev):
+            sha = rev.lower()
+        elif self._refs.supported:
+            sha = self._refs.resolve(rev.encode(self.encoding))
+        if sha and self._find_in_graph([sha])[0] is not None:
+            # commit graphs are not rewritten when commits are pruned
+            return self._cat_file_check(sha.encode()) is not None
         cmd = [GIT, 'rev-list', '-n', '1', rev]
         p = subprocess.Popen(
             cmd, cwd=self.path, stdout=subprocess.PIPE,
@@ -256,14 +1169,25 @@ class GitRepo(VCSRepo):
         return p.returncode == 0
 
     def __len__(self):
-        cmd = [GIT, 'rev-list', '--all']
+        # the fingerprint only covers refs which GitRefs can read
+        key = None
+        if self._refs.supported:
+            key = self._refs.fingerprint()
+        cached = getattr(self, '_len_cache', None)
+        if key is not None and cached is not None and cached[0] == key:
+            return cached[1]
+        cmd = [GIT, 'rev-list', '--all', '--count']
         p = subprocess.Popen(
             cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
         stdout, stderr = p.communicate()
-        return len(stdout.splitlines())
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
+        count = int(stdout)
+        self._len_cache = (key, count)
+        return count
 
-    def log(
+    def iter_log(
         self, revrange=None, limit=None, firstparent=False, merges=None,
         path=None, follow=False
     ):
@@ -277,16 +1201,15 @@ class GitRepo(VCSRepo):
                 cmd.append('--merges')
             else:
                 cmd.append('--no-merges')
-        single = False
         if revrange is None:
             if self.empty():
-                return []
+                return
             cmd.append('--all')
         elif isinstance(revrange, (tuple, list)):
             if revrange[0] is None:
                 if revrange[1] is None:
                     if self.empty():
-                        return []
+                        return
                     cmd.append('--all')
                 else:
                     cmd.append(revrange[1])
@@ -300,58 +1223,204 @@ class GitRepo(VCSRepo):
             entry = self._commit_cache.get(rev)
             if entry:
                 entry._cached = True
-                return entry
+                yield entry
+                return
+            if self._store is not None and not path and merges is None:
+                entry = self._read_commit(rev)
+                if entry:
+                    yield entry
+                    return
             cmd.extend(['-1', rev])
-            single = True
         if path:
             if follow:
                 cmd.append('--follow')
             cmd.extend(['--', type(self).cleanPath(path)])
-        output = self._command(cmd).decode(self.encoding, 'replace')
-
-        results = []
-        for log in output.split('\0'):
+        for log in self._command_records(cmd, b'\0'):
+            log = log.decode(self.encoding, 'replace')
             rev, parents, date, author, message = log.split('\n', 4)
             parents = parents.split()
             date = parse_isodate(date)
             entry = CommitLogEntry(rev, parents, date, author, message)
             if rev not in self._commit_cache:
                 self._commit_cache[rev] = entry
-            if single:
-                return entry
-            results.append(entry)
-        return results
+            yield entry
+
+    def _read_commit(self, rev):
+        """Build a log entry from the commit object, or return None"""
+        obj = self._cat_file((rev + '^{commit}').encode())
+        if obj is None or obj.type != 'commit':
+            return None
+        header, sep, message = obj.data.partition(b'\n\n')
+        parents = []
+        author = None
+        for line in header.split(b'\n'):
+            if line.startswith(b'parent '):
+                parents.append(line[7:].decode())
+            elif line.startswith(b'author '):
+                author = line[7:]
+            elif line.startswith(b'encoding '):
+                # leave re-encoding to git
+                return None
+        if author is None:
+            return None
+        author, ts, tz = author.rsplit(b' ', 2)
+        tz = UTCOffset(str(tz.decode()))
+        date = datetime.datetime.fromtimestamp(int(ts), tz)
+        author = author.decode(self.encoding, 'replace')
+        message = message.decode(self.encoding, 'replace')
+        entry = CommitLogEntry(obj.sha, parents, date, author, message)
+        if obj.sha not in self._commit_cache:
+            self._commit_cache[obj.sha] = entry
+        return entry
 
     def changed(self, rev):
         cmd = [GIT, 'diff-tree', '-z', '-C', '-r', '-m', '--no-commit-id', '--first-parent', '--root', rev]
-        output = self._command(cmd)
-        results = []
-        for line in output.rstrip(b'\0').split(b'\0:'):
-            if not line:
+        records = self._command_records(cmd, b'\0')
+        return list(_iter_raw(records, self.encoding))
+
+    def changed_many(self, revs):
+        """Files that changed in each of many revisions
+
+        All the revisions are fed to a single ``git diff-tree --stdin``
+        process, and results are produced as its output arrives.
+
+        """
+        cmd = [
+            GIT, 'diff-tree', '--stdin', '--always', '-z', '-C', '-r', '-m',
+            '--first-parent', '--root'
+        ]
+        # lists of requested revisions, one per commit written to diff-tree
+        pending = collections.deque()
+
+        def feed():
+            last = None
+            for rev in revs:
+                sha = self.canonical_rev(rev)
+                obj = self._cat_file_check((sha + '^{commit}').encode())
+                if obj is None:
+                    raise subprocess.CalledProcessError(128, cmd)
+                if obj.sha == last:
+                    pending[-1].append(rev)
+                    continue
+                pending.append([rev])
+                last = obj.sha
+                yield obj.sha.encode() + b'\n'
+
+        records = iter(self._command_records(cmd, b'\0', input=feed()))
+        current = changes = None
+        for record in records:
+            if record.startswith(b':'):
+                changes.append(_parse_raw(record, records, self.encoding))
                 continue
-            path = line.split(b'\0')
-            meta = path.pop(0).split()
-            status = meta[3].decode()[0]
-            src_path = path[0].decode(self.encoding, 'replace')
-            if len(path) == 2:
-                dst_path = path[1].decode(self.encoding, 'replace')
-                entry = FileChangeInfo(dst_path, str(status), src_path)
-            else:
-                entry = FileChangeInfo(src_path, str(status))
-            results.append(entry)
-        return results
+            # a merge has one header for each parent
+            if record == current:
+                continue
+            if current is not None:
+                for rev in pending.popleft():
+                    yield rev, changes
+            current = record
+            changes = []
+        if current is not None:
+            for rev in pending.popleft():
+                yield rev, changes
 
     def pdiff(self, rev):
         cmd = [GIT, 'diff-tree', '-p', '-r', '-m', '--no-commit-id', '--first-parent', '--root', rev]
         return self._command(cmd).decode(self.encoding)
 
+    def pdiff_stream(self, rev, out=None, max_bytes=None):
+        cmd = [GIT, 'diff-tree', '-p', '-r', '-m', '--no-commit-id', '--first-parent', '--root', rev]
+        return self._write_chunks(self._command_chunks(cmd), out, max_bytes)
+
     def diff(self, rev_a, rev_b, path=None):
         cmd = [GIT, 'diff', rev_a, rev_b]
         if path is not None:
             cmd.extend(['--', type(self).cleanPath(path)])
         return self._command(cmd).decode(self.encoding)
 
+    def diff_stream(self, rev_a, rev_b, path=None, out=None, max_bytes=None):
+        cmd = [GIT, 'diff', rev_a, rev_b]
+        if path is not None:
+            cmd.extend(['--', type(self).cleanPath(path)])
+        return self._write_chunks(self._command_chunks(cmd), out, max_bytes)
+
+    def _numstat(self, cmd):
+        records = self._command_records(cmd, b'\0')
+        results = []
+        for record in records:
+            added, deleted, path = record.split(b'\t', 2)
+            if not path:
+                # renames and copies are followed by the source and the
+                # destination path
+                next(records)
+                path = next(records)
+            binary = added == b'-'
+            results.append(DiffStat(
+                path.decode(self.encoding, 'replace'),
+                0 if binary else int(added),
+                0 if binary else int(deleted),
+                binary
+            ))
+        return results
+
+    def pstat(self, rev):
+        cmd = [GIT, 'diff-tree', '--numstat', '-z', '-r', '-m', '--no-commit-id', '--first-parent', '--root', rev]
+        return self._numstat(cmd)
+
+    def diffstat(self, rev_a, rev_b, path=None):
+        cmd = [GIT, 'diff', '--numstat', '-z', rev_a, rev_b]
+        if path is not None:
+            cmd.extend(['--', type(self).cleanPath(path)])
+        return self._numstat(cmd)
+
+    def is_ancestor(self, rev1, rev2):
+        """Determine whether rev1 is an ancestor of rev2
+
+        A revision counts as its own ancestor.
+
+        """
+        shas = [self._commit_sha(rev1), self._commit_sha(rev2)]
+        graph, positions = self._commit_graph(shas)
+        if graph is not None:
+            return graph.is_ancestor(*positions)
+        cmd = [GIT, 'merge-base', '--is-ancestor'] + shas
+        p = subprocess.Popen(
+            cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = p.communicate()
+        if p.returncode not in (0, 1):
+            raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
+        return p.returncode == 0
+
+    def ancestor_many(self, pairs):
+        """Find the common ancestors of many pairs of revisions
+
+        :param pairs: An iterable of ``(rev1, rev2)`` tuples.
+        :returns: A list with the result of :meth:`ancestor` for each pair.
+
+        All the pairs are answered with a single walk setup, so this is much
+        cheaper than calling :meth:`ancestor` repeatedly.
+
+        """
+        pairs = [
+            (self._commit_sha(rev1), self._commit_sha(rev2))
+            for rev1, rev2 in pairs
+        ]
+        shas = sorted(set(x for pair in pairs for x in pair))
+        graph, positions = self._commit_graph(shas)
+        if graph is None:
+            return [self._merge_base(rev1, rev2) for rev1, rev2 in pairs]
+        pos = dict(zip(shas, positions))
+        results = []
+        for rev1, rev2 in pairs:
+            bases = graph.merge_bases(pos[rev1], pos[rev2])
+            results.append(graph.sha(bases[0]) if bases else None)
+        return results
+
     def ancestor(self, rev1, rev2):
+        return self.ancestor_many([(rev1, rev2)])[0]
+
+    def _merge_base(self, rev1, rev2):
         cmd = [GIT, 'merge-base', rev1, rev2]
         p = subprocess.Popen(
             cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
@@ -365,32 +1434,73 @@ class GitRepo(VCSRepo):
             raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
 
     def blame(self, rev, path):
+        return list(self.iter_blame(rev, path))
+
+    def iter_blame(self, rev, path):
+        """Iterate over the annotated lines of a file
+
+        Lines are produced in order as ``git blame --incremental`` reports
+        the hunks covering them. Completed results are stored in a cache
+        keyed on the commit and path, so blaming the same file at the same
+        commit again does not run git.
+
+        """
         path = type(self).cleanPath(path)
-        ls = self.ls(rev, path, directory=True)
-        assert len(ls) == 1
-        if ls[0].get('type') != 'f':
+        if self.stat(rev, path).type != 'f':
             raise BadFileType(rev, path)
-        cmd = [GIT, 'blame', '--root', '--encoding=none', '-p', rev, '--', path]
-        output = self._command(cmd)
-        rev = None
+        commit = self._cat_file_check((str(rev) + '^{commit}').encode()).sha
+        epath = path.encode(self.encoding)
+        lines = self._cat(commit, epath).split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        lines = [x[:-1] if x.endswith(b'\r') else x for x in lines]
+        key = hashlib.sha1(commit.encode() + b'\0' + epath).hexdigest()
+        try:
+            hunks = self._blame_cache[key]
+        except KeyError:
+            pass
+        else:
+            i = 0
+            for count, rev, author, date in hunks:
+                for line in lines[i:i + count]:
+                    yield BlameInfo(rev, author, date, line)
+                i += count
+            return
+
+        cmd = [GIT, 'blame', '--root', '--incremental', '--encoding=none', commit, '--', path]
         revinfo = {}
-        results = []
-        for line in output.splitlines():
-            if line.startswith(b'\t'):
-                ri = revinfo[rev]
-                author = ri['author'] + ' ' + ri['author-mail']
-                ts = int(ri['author-time'])
-                tz = UTCOffset(str(ri['author-tz']))
-                date = datetime.datetime.fromtimestamp(ts, tz)
-                entry = BlameInfo(rev, author, date, line[1:])
-                results.append(entry)
-            else:
-                k, v = line.decode(self.encoding, 'replace').split(None, 1)
-                if rev_rx.match(k):
-                    rev = k
-                else:
-                    revinfo.setdefault(rev, {})[k] = v
-        return results
+        infos = {}
+        pending = {}
+        hunks = []
+        current = None
+        next_line = 1
+        for line in self._command_records(cmd, b'\n'):
+            if current is None:
+                sha, orig, final, count = line.decode().split()
+                current = sha, int(final), int(count)
+                continue
+            k, sep, v = line.partition(b' ')
+            if k != b'filename':
+                revinfo.setdefault(current[0], {})[k] = v
+                continue
+            sha, final, count = current
+            current = None
+            pending[final] = sha, count
+            while next_line in pending:
+                sha, count = pending.pop(next_line)
+                if sha not in infos:
+                    ri = revinfo[sha]
+                    author = ri[b'author'] + b' ' + ri[b'author-mail']
+                    author = author.decode(self.encoding, 'replace')
+                    tz = UTCOffset(str(ri[b'author-tz'].decode()))
+                    date = datetime.datetime.fromtimestamp(int(ri[b'author-time']), tz)
+                    infos[sha] = author, date
+                author, date = infos[sha]
+                for line in lines[next_line - 1:next_line - 1 + count]:
+                    yield BlameInfo(sha, author, date, line)
+                hunks.append((count, sha, author, date))
+                next_line += count
+        self._blame_cache[key] = hunks
 
     def tip(self, head):
         return self.canonical_rev(head)
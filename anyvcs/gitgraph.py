@@ -0,0 +1,299 @@
+# Copyright (c) 2013-2014, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import binascii
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+RESULT = 8
+
+
+class CommitGraph(object):
+    """A memory-mapped file in git's commit-graph format
+
+    Only the chunks needed to walk history are used: the OID fanout and
+    lookup tables, the commit data (parents and topological level) and the
+    extra edge list for octopus merges. Commits are referred to by their
+    position in the file.
+
+    :raises ValueError: if the file can not be used, e.g. because it is
+                        part of a split commit-graph chain or was written
+                        without generation numbers.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except (ValueError, struct.error):
+            self.map.close()
+            raise
+
+    def _parse(self):
+        m = self.map
+        if m[:4] != b'CGPH':
+            raise ValueError('not a commit-graph file')
+        version, hash_version, nchunks, nbase = struct.unpack_from('>BBBB', m, 4)
+        if version != 1 or hash_version != 1 or nbase != 0:
+            raise ValueError('unsupported commit-graph file')
+        chunks = {}
+        for i in range(nchunks):
+            cid, offset = struct.unpack_from('>4sQ', m, 8 + 12 * i)
+            chunks[cid] = offset
+        for cid in (b'OIDF', b'OIDL', b'CDAT'):
+            if cid not in chunks:
+                raise ValueError('commit-graph is missing a required chunk')
+        self.fanout = chunks[b'OIDF']
+        self.oids = chunks[b'OIDL']
+        self.cdat = chunks[b'CDAT']
+        self.edges = chunks.get(b'EDGE')
+        self.count, = struct.unpack_from('>I', m, self.fanout + 255 * 4)
+        if self.count and self.generation(0) == 0:
+            raise ValueError('commit-graph has no generation numbers')
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, pos):
+        p = self.oids + 20 * pos
+        return binascii.hexlify(self.map[p:p + 20]).decode()
+
+    def find(self, sha):
+        """Get the position of a commit, or None if it is not in the graph"""
+        binsha = binascii.unhexlify(sha)
+        first = bytearray(binsha[:1])[0]
+        if first:
+            lo, = struct.unpack_from('>I', self.map, self.fanout + (first - 1) * 4)
+        else:
+            lo = 0
+        hi, = struct.unpack_from('>I', self.map, self.fanout + first * 4)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            p = self.oids + 20 * mid
+            other = self.map[p:p + 20]
+            if other < binsha:
+                lo = mid + 1
+            elif other > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def parents(self, pos):
+        p1, p2 = struct.unpack_from('>II', self.map, self.cdat + 36 * pos + 20)
+        if p1 == GRAPH_PARENT_NONE:
+            return []
+        if p2 == GRAPH_PARENT_NONE:
+            return [p1]
+        if not p2 & GRAPH_EXTRA_EDGES:
+            return [p1, p2]
+        results = [p1]
+        i = p2 & ~GRAPH_EXTRA_EDGES
+        while True:
+            edge, = struct.unpack_from('>I', self.map, self.edges + 4 * i)
+            results.append(edge & ~GRAPH_LAST_EDGE)
+            if edge & GRAPH_LAST_EDGE:
+                return results
+            i += 1
+
+    def generation(self, pos):
+        hi, = struct.unpack_from('>I', self.map, self.cdat + 36 * pos + 28)
+        return hi >> 2
+
+    def commit_time(self, pos):
+        hi, lo = struct.unpack_from('>II', self.map, self.cdat + 36 * pos + 28)
+        return (hi & 3) << 32 | lo
+
+    def is_ancestor(self, a, b):
+        """Is commit ``a`` an ancestor of (or the same as) commit ``b``?
+
+        Only commits whose generation is at least that of ``a`` are visited.
+
+        """
+        if a == b:
+            return True
+        gen = self.generation(a)
+        if self.generation(b) <= gen:
+            return False
+        seen = set([b])
+        stack = [b]
+        while stack:
+            for p in self.parents(stack.pop()):
+                if p == a:
+                    return True
+                if p not in seen and self.generation(p) > gen:
+                    seen.add(p)
+                    stack.append(p)
+        return False
+
+    def merge_bases(self, a, b):
+        """Find the best common ancestors of commits ``a`` and ``b``
+
+        This is the walk ``git merge-base`` does, ordered by generation
+        number instead of commit date.
+
+        :returns: a list of positions, newest first.
+
+        """
+        if a == b:
+            return [a]
+        flags = {a: PARENT1, b: PARENT2}
+        # entries carry whether they were queued without STALE, so the walk
+        # can stop once only stale commits are left
+        queue = [(-self.generation(a), a, True), (-self.generation(b), b, True)]
+        heapq.heapify(queue)
+        nonstale = 2
+        results = []
+        while nonstale:
+            gen, pos, live = heapq.heappop(queue)
+            if live:
+                nonstale -= 1
+            f = flags[pos] & (PARENT1 | PARENT2 | STALE)
+            if f == PARENT1 | PARENT2:
+                if not flags[pos] & RESULT:
+                    flags[pos] |= RESULT
+                    results.append(pos)
+                f |= STALE
+            for p in self.parents(pos):
+                old = flags.get(p, 0)
+                if old & f == f:
+                    continue
+                flags[p] = old | f
+                live = not flags[p] & STALE
+                if live:
+                    nonstale += 1
+                heapq.heappush(queue, (-self.generation(p), p, live))
+        results = [x for x in results if not flags[x] & STALE]
+        if len(results) > 1:
+            results = [
+                x for x in results
+                if not any(
+                    y != x and self.is_ancestor(x, y) for y in results
+                )
+            ]
+            # git lists the most recently committed merge base first
+            results.sort(key=self.commit_time, reverse=True)
+        return results
+
+
+def write_commit_graph(path, commits):
+    """Write a commit-graph file for the given commits
+
+    :param path: The file to (atomically) create.
+    :param commits: An iterable of ``(sha, parent_shas, commit_time)`` with
+                    every parent appearing before its children, as produced
+                    by ``git rev-list --topo-order --reverse --parents
+                    --timestamp``.
+
+    Tree ids are not recorded.
+
+    """
+    level = {}
+    parents = {}
+    times = {}
+    for sha, ps, t in commits:
+        binsha = binascii.unhexlify(sha)
+        bps = [binascii.unhexlify(x) for x in ps]
+        parents[binsha] = bps
+        times[binsha] = t
+        level[binsha] = 1 + max([level[x] for x in bps] or [0])
+    oids = sorted(parents)
+    pos = dict((x, i) for i, x in enumerate(oids))
+
+    fanout = [0] * 256
+    for x in oids:
+        fanout[bytearray(x[:1])[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+    cdat = []
+    edges = []
+    for x in oids:
+        ps = [pos[p] for p in parents[x]]
+        p1 = ps[0] if ps else GRAPH_PARENT_NONE
+        if len(ps) < 2:
+            p2 = GRAPH_PARENT_NONE
+        elif len(ps) == 2:
+            p2 = ps[1]
+        else:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(ps[1:-1])
+            edges.append(ps[-1] | GRAPH_LAST_EDGE)
+        t = times[x]
+        cdat.append(b'\0' * 20 + struct.pack(
+            '>IIII', p1, p2, level[x] << 2 | (t >> 32) & 3, t & 0xffffffff))
+
+    chunks = [
+        (b'OIDF', struct.pack('>256I', *fanout)),
+        (b'OIDL', b''.join(oids)),
+        (b'CDAT', b''.join(cdat)),
+    ]
+    if edges:
+        chunks.append((b'EDGE', struct.pack('>%dI' % len(edges), *edges)))
+    header = struct.pack('>4sBBBB', b'CGPH', 1, 1, len(chunks), 0)
+    offset = len(header) + 12 * (len(chunks) + 1)
+    toc = []
+    for cid, data in chunks:
+        toc.append(struct.pack('>4sQ', cid, offset))
+        offset += len(data)
+    toc.append(struct.pack('>4sQ', b'\0\0\0\0', offset))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    renamed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(b''.join(toc))
+            for cid, data in chunks:
+                f.write(data)
+            # git expects a trailing checksum; it is not verified here
+            f.write(b'\0' * 20)
+        os.rename(tmp, path)
+        renamed = True
+    finally:
+        if not renamed:
+            os.unlink(tmp)
+
+# vi:set tabstop=4 softtabstop=4 shiftwidth=4 expandtab:
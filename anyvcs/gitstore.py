@@ -0,0 +1,480 @@
+# Copyright (c) 2013-2014, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import binascii
+import collections
+import errno
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+type_names = {
+    OBJ_COMMIT: 'commit',
+    OBJ_TREE: 'tree',
+    OBJ_BLOB: 'blob',
+    OBJ_TAG: 'tag',
+}
+
+
+class UnsupportedObject(Exception):
+    """The object is stored in a way this module can not read"""
+
+
+def _inflate(buf, pos, size, chunk=4096):
+    """Inflate a zlib stream starting at buf[pos] until size bytes are out"""
+    d = zlib.decompressobj()
+    out = []
+    n = 0
+    end = len(buf)
+    while n < size and pos < end:
+        data = d.decompress(buf[pos:pos + chunk], size - n)
+        while d.unconsumed_tail and n + len(data) < size:
+            data += d.decompress(d.unconsumed_tail, size - n - len(data))
+        out.append(data)
+        n += len(data)
+        pos += chunk
+        chunk = min(chunk * 2, 1 << 20)
+    data = b''.join(out)
+    if len(data) != size:
+        raise UnsupportedObject('truncated zlib stream')
+    return data
+
+
+def _delta_size(delta, pos):
+    size = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def apply_delta(base, delta):
+    """Apply a git delta to base and return the result"""
+    delta = bytearray(delta)
+    src_size, pos = _delta_size(delta, 0)
+    dst_size, pos = _delta_size(delta, pos)
+    if src_size != len(base):
+        raise UnsupportedObject('delta base size mismatch')
+    out = bytearray()
+    n = len(delta)
+    while pos < n:
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if c & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif c:
+            out += delta[pos:pos + c]
+            pos += c
+        else:
+            raise UnsupportedObject('invalid delta opcode')
+    if len(out) != dst_size:
+        raise UnsupportedObject('delta result size mismatch')
+    return bytes(out)
+
+
+class PackIndex(object):
+    """A memory-mapped ``.idx`` file (version 1 or 2)"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] == b'\377tOc':
+            version, = struct.unpack_from('>I', self.map, 4)
+            if version != 2:
+                raise UnsupportedObject('unknown pack index version')
+            self.version = 2
+            self.fanout = 8
+        else:
+            self.version = 1
+            self.fanout = 0
+        self.count, = struct.unpack_from('>I', self.map, self.fanout + 255 * 4)
+        base = self.fanout + 256 * 4
+        if self.version == 2:
+            self.shas = base
+            self.offsets = base + 24 * self.count
+            self.large = self.offsets + 4 * self.count
+            self.stride = 20
+        else:
+            self.shas = base + 4
+            self.offsets = base
+            self.stride = 24
+
+    def close(self):
+        self.map.close()
+
+    def _sha(self, i):
+        p = self.shas + i * self.stride
+        return self.map[p:p + 20]
+
+    def find(self, binsha):
+        """Get the pack offset of an object, or None"""
+        first = bytearray(binsha[:1])[0]
+        if first:
+            lo, = struct.unpack_from('>I', self.map, self.fanout + (first - 1) * 4)
+        else:
+            lo = 0
+        hi, = struct.unpack_from('>I', self.map, self.fanout + first * 4)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sha = self._sha(mid)
+            if sha < binsha:
+                lo = mid + 1
+            elif sha > binsha:
+                hi = mid
+            else:
+                break
+        else:
+            return None
+        if self.version == 1:
+            offset, = struct.unpack_from('>I', self.map, self.offsets + mid * 24)
+            return offset
+        offset, = struct.unpack_from('>I', self.map, self.offsets + mid * 4)
+        if offset & 0x80000000:
+            p = self.large + (offset & 0x7fffffff) * 8
+            offset, = struct.unpack_from('>Q', self.map, p)
+        return offset
+
+
+class Pack(object):
+    """A memory-mapped ``.pack`` file and its index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(path[:-5] + '.idx')
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != b'PACK':
+            raise UnsupportedObject('not a pack file')
+
+    def close(self):
+        self.index.close()
+        self.map.close()
+
+    def header(self, offset):
+        """Parse an object header
+
+        :returns: ``(type, size, base, pos)`` where ``base`` is the offset of
+                  the base object for an OFS_DELTA, the binary sha of the base
+                  object for a REF_DELTA, and None otherwise, and ``pos`` is
+                  the offset of the compressed data.
+
+        """
+        hdr = bytearray(self.map[offset:offset + 32])
+        c = hdr[0]
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        i = 1
+        while c & 0x80:
+            c = hdr[i]
+            i += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if type == OBJ_OFS_DELTA:
+            c = hdr[i]
+            i += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = hdr[i]
+                i += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = offset - rel
+        elif type == OBJ_REF_DELTA:
+            base = self.map[offset + i:offset + i + 20]
+            i += 20
+        return type, size, base, offset + i
+
+    def inflate(self, pos, size):
+        return _inflate(self.map, pos, size)
+
+
+class DeltaBaseCache(object):
+    """A size-bounded cache of inflated objects used as delta bases
+
+    Entries are evicted oldest first once more than ``limit`` bytes are
+    held.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+        self.entries = {}
+        self.order = collections.deque()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        if key in self.entries or len(value[1]) > self.limit:
+            return
+        self.entries[key] = value
+        self.order.append(key)
+        self.total += len(value[1])
+        while self.total > self.limit:
+            old = self.entries.pop(self.order.popleft())
+            self.total -= len(old[1])
+
+
+class ObjectStore(object):
+    """Read objects straight out of a git repository's object directory
+
+    Loose objects are inflated with zlib, and packed objects are located by
+    binary search in the memory-mapped pack indexes and have their deltas
+    resolved in memory. Alternates are followed. Objects that can not be
+    found, or are stored in a way this class does not understand, are
+    reported as missing so the caller can fall back to git itself.
+
+    """
+
+    def __init__(self, path, cache_size=16 * 1024 * 1024):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cache = DeltaBaseCache(cache_size)
+        self.dirs = [os.path.join(path, 'objects')]
+        self._load_alternates(self.dirs[0], 0)
+        self.packs = {}
+        self.pack_mtimes = {}
+        self._scan_packs()
+
+    def _load_alternates(self, objdir, depth):
+        try:
+            with open(os.path.join(objdir, 'info', 'alternates')) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or depth >= 5:
+                continue
+            alt = os.path.normpath(os.path.join(objdir, line))
+            if alt not in self.dirs:
+                self.dirs.append(alt)
+                self._load_alternates(alt, depth + 1)
+
+    def _scan_packs(self):
+        """Pick up new packs and forget removed ones
+
+        :returns: True if anything changed.
+
+        """
+        changed = False
+        seen = set()
+        for objdir in self.dirs:
+            packdir = os.path.join(objdir, 'pack')
+            try:
+                mtime = os.stat(packdir).st_mtime
+            except OSError:
+                continue
+            if self.pack_mtimes.get(packdir) == mtime:
+                seen.update(p for p in self.packs if p.startswith(packdir))
+                continue
+            self.pack_mtimes[packdir] = mtime
+            for name in sorted(os.listdir(packdir)):
+                if not name.endswith('.pack'):
+                    continue
+                p = os.path.join(packdir, name)
+                seen.add(p)
+                if p in self.packs:
+                    continue
+                try:
+                    self.packs[p] = Pack(p)
+                except (IOError, OSError, ValueError, UnsupportedObject):
+                    continue
+                changed = True
+        for p in list(self.packs):
+            if p not in seen:
+                self.packs.pop(p).close()
+                changed = True
+        return changed
+
+    def close(self):
+        with self.lock:
+            for pack in self.packs.values():
+                pack.close()
+            self.packs = {}
+            self.pack_mtimes = {}
+
+    def _loose_path(self, sha):
+        for objdir in self.dirs:
+            p = os.path.join(objdir, sha[:2], sha[2:])
+            if os.path.isfile(p):
+                return p
+        return None
+
+    def _read_loose(self, p, header_only):
+        try:
+            with open(p, 'rb') as f:
+                raw = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        d = zlib.decompressobj()
+        data = d.decompress(raw, 64)
+        while b'\0' not in data and d.unconsumed_tail:
+            data += d.decompress(d.unconsumed_tail, 64)
+        nul = data.index(b'\0')
+        type, size = data[:nul].split(b' ')
+        type = type.decode()
+        size = int(size)
+        if header_only:
+            return type, size, None
+        data = data[nul + 1:] + d.decompress(d.unconsumed_tail) + d.flush()
+        if len(data) != size:
+            raise UnsupportedObject('corrupt loose object')
+        return type, size, data
+
+    def _find_packed(self, binsha):
+        for pack in self.packs.values():
+            offset = pack.index.find(binsha)
+            if offset is not None:
+                return pack, offset
+        return None, None
+
+    def _unpack(self, pack, offset):
+        # walk down the delta chain to a base object, or to an object which
+        # is already cached, then apply the deltas oldest first
+        chain = []
+        seen = set()
+        while True:
+            key = (pack.path, offset)
+            hit = self.cache.get(key)
+            if hit is not None:
+                type, data = hit
+                break
+            if key in seen:
+                raise UnsupportedObject('delta chain loops')
+            seen.add(key)
+            type, size, base, pos = pack.header(offset)
+            data = pack.inflate(pos, size)
+            if type == OBJ_OFS_DELTA:
+                chain.append((key, data))
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                chain.append((key, data))
+                pack, offset = self._find_packed(base)
+                if pack is None:
+                    raise UnsupportedObject('delta base is not packed')
+            elif type not in type_names:
+                raise UnsupportedObject('unknown object type %d' % type)
+            else:
+                type = type_names[type]
+                if chain:
+                    self.cache.put(key, (type, data))
+                break
+        for i in range(len(chain) - 1, -1, -1):
+            key, delta = chain[i]
+            data = apply_delta(data, delta)
+            if i:
+                self.cache.put(key, (type, data))
+        return type, data
+
+    def _packed_size(self, pack, offset):
+        type, size, base, pos = pack.header(offset)
+        if type in type_names:
+            return type_names[type], size
+        # the result size is at the start of the delta data
+        delta = bytearray(_inflate(pack.map, pos, min(size, 20)))
+        src_size, i = _delta_size(delta, 0)
+        dst_size, i = _delta_size(delta, i)
+        seen = set()
+        while type in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            if type == OBJ_OFS_DELTA:
+                offset = base
+            else:
+                pack, offset = self._find_packed(base)
+                if pack is None:
+                    raise UnsupportedObject('delta base is not packed')
+            if (pack.path, offset) in seen:
+                raise UnsupportedObject('delta chain loops')
+            seen.add((pack.path, offset))
+            type, size, base, pos = pack.header(offset)
+        if type not in type_names:
+            raise UnsupportedObject('unknown object type %d' % type)
+        return type_names[type], dst_size
+
+    def _read(self, sha, header_only):
+        binsha = binascii.unhexlify(sha)
+        pack, offset = self._find_packed(binsha)
+        if pack is None:
+            p = self._loose_path(sha)
+            if p is not None:
+                return self._read_loose(p, header_only)
+            if not self._scan_packs():
+                return None
+            pack, offset = self._find_packed(binsha)
+            if pack is None:
+                return None
+        if header_only:
+            type, size = self._packed_size(pack, offset)
+            return type, size, None
+        type, data = self._unpack(pack, offset)
+        return type, len(data), data
+
+    def read(self, sha, header_only=False):
+        """Read an object
+
+        :param str sha: The full hex id of the object.
+        :param bool header_only: Only determine the type and size.
+        :returns: ``(type, size, data)``, where ``data`` is None if
+                  ``header_only`` is True, or None if the object could not be
+                  read.
+
+        """
+        with self.lock:
+            try:
+                return self._read(sha, header_only)
+            except (UnsupportedObject, ValueError, IndexError, zlib.error):
+                return None
+
+# vi:set tabstop=4 softtabstop=4 shiftwidth=4 expandtab:
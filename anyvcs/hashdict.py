@@ -78,6 +78,21 @@ class HashDict(collections.MutableMapping):
             os.ftruncate(f.fileno(), 0)
             f.write(value)
 
+    def append(self, key, value):
+        """Append value to the value stored for key, creating it if needed."""
+        int(key, 16)
+        d = os.path.join(self.path, key[:2])
+        p = os.path.join(d, key[2:])
+        try:
+            os.mkdir(d, self.dirmode)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(p, os.O_WRONLY | os.O_APPEND | os.O_CREAT, self.mode)
+        with os.fdopen(fd, 'ab') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(value)
+
     def __delitem__(self, key):
         int(key, 16)
         d = os.path.join(self.path, key[:2])
@@ -26,12 +26,26 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
+import bisect
+import collections
 import datetime
+import fcntl
+import mmap
 import os
 import re
+import struct
 import subprocess
+import sys
+import threading
+import time
 import errno
+import heapq
+import tempfile
+import zlib
 from .common import *
+from .hashdict import HashDict
+from .pathindex import RevisionIndex, with_parents
 
 HG = 'hg'
 
@@ -55,13 +69,496 @@ def parse_hgdate(datestr):
     return date.replace(tzinfo=UTCOffset(-int(tzoffset) / 60))
 
 
+def _skip_bytes(chunks, n):
+    try:
+        for chunk in chunks:
+            if n:
+                chunk, n = chunk[n:], max(0, n - len(chunk))
+            if chunk:
+                yield chunk
+    finally:
+        chunks.close()
+
+
+class HgManifest(object):
+    """The parsed manifest of a changeset
+
+    Entries are kept in a sorted array of paths, so a path or directory can
+    be found by binary search, and every directory has a list of its children
+    in manifest order.
+
+    :attr:`size` estimates the memory held by the manifest in bytes.
+
+    """
+
+    # rough cost of the tuples, strings and list slots behind each entry
+    entry_overhead = 256
+
+    def __init__(self, output):
+        entries = []
+        for line in output.splitlines():
+            m = manifest_rx.match(line)
+            assert m, 'unexpected output: ' + line
+            entries.append(m.group('name', 'type', 'object'))
+        entries.sort()
+        self.names = [x[0] for x in entries]
+        self.entries = entries
+        self.children = {'': []}
+        for name, t, objid in entries:
+            parent = ''
+            start = 0
+            i = name.find('/')
+            while i != -1:
+                d = name[:i]
+                if d not in self.children:
+                    self.children[d] = []
+                    self.children[parent].append(('d', name[start:i], None))
+                parent = d
+                start = i + 1
+                i = name.find('/', start)
+            self.children[parent].append((t, name[start:], objid))
+        self.size = len(output) + self.entry_overhead * len(entries)
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, path):
+        """Get the index of a file, or None if it is not in the manifest"""
+        i = bisect.bisect_left(self.names, path)
+        if i < len(self.names) and self.names[i] == path:
+            return i
+        return None
+
+    def span(self, prefix):
+        """Get the range of indexes of the paths starting with prefix
+
+        ``prefix`` must be empty or end with a slash.
+
+        """
+        if not prefix:
+            return 0, len(self.names)
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix[:-1] + '0', lo)
+        return lo, hi
+
+
+class HgFilesLog(object):
+    """An append-only log of the parents and files of every revision
+
+    Records are stored in ``<path>.dat`` and located through a table of
+    fixed-width ``(offset, length)`` entries in ``<path>.idx``, one for each
+    revision. Both files are memory-mapped, so readers take no lock and only
+    touch the revisions they look up. Writers append under an exclusive lock
+    on the table, writing the records before the table entries that point to
+    them.
+
+    """
+
+    entry = struct.Struct('>QI')
+    header = struct.Struct('>20sH')
+
+    def __init__(self, path):
+        self.index_path = path + '.idx'
+        self.data_path = path + '.dat'
+        self.index = None
+        self.data = None
+        self.count = 0
+        self._map()
+
+    def _map(self):
+        self.close()
+        maps = []
+        for path in (self.index_path, self.data_path):
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+            try:
+                size = os.fstat(fd).st_size
+                maps.append(size and mmap.mmap(fd, size, access=mmap.ACCESS_READ))
+            finally:
+                os.close(fd)
+        self.index, self.data = maps
+        self.count = len(self.index or b'') // self.entry.size
+
+    def close(self):
+        for m in (self.index, self.data):
+            if m:
+                m.close()
+        self.index = self.data = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, rev):
+        """Get the node, parent revisions and changed files of a revision"""
+        if not 0 <= rev < self.count:
+            raise IndexError(rev)
+        offset, length = self.entry.unpack_from(self.index, rev * self.entry.size)
+        record = self.data[offset:offset + length]
+        node, nparents = self.header.unpack_from(record)
+        i = self.header.size + 4 * nparents
+        parents = struct.unpack_from('>%di' % nparents, record, self.header.size)
+        files = record[i:].split(b'\n') if len(record) > i else []
+        return binascii.hexlify(node).decode(), list(parents), files
+
+    def update(self, count, fetch):
+        """Make sure the log covers the first count revisions
+
+        :param fetch: A function which is given the first missing revision
+                      and returns an iterable of ``(rev, node, parents,
+                      files)`` for it and every later revision.
+
+        """
+        if self.count >= count:
+            return
+        self._map()
+        if self.count >= count:
+            return
+        with open(self.index_path, 'r+b') as index:
+            fcntl.lockf(index, fcntl.LOCK_EX)
+            size = os.fstat(index.fileno()).st_size
+            n = size // self.entry.size
+            end = 0
+            if n:
+                index.seek((n - 1) * self.entry.size)
+                offset, length = self.entry.unpack(index.read(self.entry.size))
+                end = offset + length
+            entries = []
+            if n < count:
+                with open(self.data_path, 'r+b') as data:
+                    # drop anything left over from an interrupted writer
+                    data.truncate(end)
+                    data.seek(end)
+                    for rev, node, parents, files in fetch(n):
+                        expected = n + len(entries)
+                        if rev < expected:
+                            raise ValueError(
+                                'revision %d was fetched out of order' % rev)
+                        # revisions which were skipped get an empty record
+                        while expected < rev:
+                            record = self.header.pack(b'\0' * 20, 0)
+                            data.write(record)
+                            entries.append(self.entry.pack(end, len(record)))
+                            end += len(record)
+                            expected += 1
+                        record = self.header.pack(
+                            binascii.unhexlify(node), len(parents))
+                        record += struct.pack('>%di' % len(parents), *parents)
+                        record += b'\n'.join(files)
+                        data.write(record)
+                        entries.append(self.entry.pack(end, len(record)))
+                        end += len(record)
+                    data.flush()
+                index.truncate(n * self.entry.size)
+                index.seek(n * self.entry.size)
+                index.write(b''.join(entries))
+                index.flush()
+        self._map()
+
+
+class HgPathIndex(RevisionIndex):
+    """An index from paths to the revisions that touched them
+
+    Every path changed by a revision, and each of its parent directories, is
+    mapped to the revision number. Revisions are indexed in order from an
+    :class:`HgFilesLog`, so the index only has to catch up with new
+    changesets.
+
+    """
+
+    def __init__(self, private_path):
+        super(HgPathIndex, self).__init__(
+            os.path.join(private_path, 'path-revs'))
+
+    def update(self, log):
+        """Index the revisions of log which are not indexed yet"""
+        def fetch(start):
+            for rev in range(start, len(log)):
+                yield rev, with_parents(log[rev][2])
+        super(HgPathIndex, self).update(len(log), fetch)
+
+    def lookup(self, rev, paths, log):
+        """Find the last revisions that touched paths
+
+        Only ancestors of ``rev`` are considered, and history is walked no
+        further back than the oldest candidate revision.
+
+        :param int rev: The revision number to start from.
+        :param paths: The paths to look up, as bytes.
+        :param log: The :class:`HgFilesLog` of the repository.
+        :returns: A dictionary from path to revision number.
+
+        """
+        walk = [-rev]
+        seen = set([rev])
+
+        def is_ancestor(r):
+            while walk and -walk[0] > r:
+                for p in log[-heapq.heappop(walk)][1]:
+                    if p not in seen:
+                        seen.add(p)
+                        heapq.heappush(walk, -p)
+            return r in seen
+
+        results = {}
+        for path in paths:
+            for r in self.revisions(path):
+                if r <= rev and is_ancestor(r):
+                    results[path] = r
+                    break
+        return results
+
+
+class HgCommandServer(object):
+    """A long-running ``hg serve --cmdserver pipe`` process.
+
+    Commands are sent to the server with its ``runcommand`` request, so each
+    one costs a pipe round-trip instead of starting Mercurial. The process is
+    started on first use, restarted if it dies, and stopped once it has been
+    idle for ``idle_timeout`` seconds.
+
+    """
+
+    def __init__(self, path, idle_timeout=60):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.lock = threading.Lock()
+        self.last_used = 0
+        self.timer = None
+
+    def _read_message(self):
+        header = self.process.stdout.read(5)
+        if len(header) != 5:
+            raise IOError('hg command server exited unexpectedly')
+        channel, length = struct.unpack('>cI', header)
+        return channel, length
+
+    def _read(self, length):
+        data = self.process.stdout.read(length)
+        if len(data) != length:
+            raise IOError('hg command server exited unexpectedly')
+        return data
+
+    def _start(self):
+        cmd = [HG, 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False']
+        self.process = subprocess.Popen(
+            cmd, cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        channel, length = self._read_message()
+        hello = self._read(length)
+        if channel != b'o' or b'runcommand' not in hello.split(b'\n')[0]:
+            self._stop()
+            raise IOError('unexpected hg command server greeting')
+
+    def _stop(self):
+        p = self.process
+        self.process = None
+        if p is None:
+            return
+        for f in (p.stdin, p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        if p.poll() is None:
+            p.terminate()
+        p.wait()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._stop()
+
+    def _idle(self):
+        with self.lock:
+            self.timer = None
+            if self.process is None:
+                return
+            if time.time() - self.last_used >= self.idle_timeout:
+                self._stop()
+            else:
+                self._schedule()
+
+    def _schedule(self):
+        if self.timer is None and self.idle_timeout is not None:
+            delay = self.idle_timeout - (time.time() - self.last_used)
+            self.timer = threading.Timer(max(delay, 0), self._idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _send(self, args):
+        p = self.process
+        data = b'\0'.join(args)
+        p.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        p.stdin.flush()
+
+    def _receive(self, err):
+        """Read messages up to the next output or the end of the command
+
+        :param list err: Data from the error channel is appended to it.
+        :returns: ``(data, None)`` for output, or ``(None, rc)`` once the
+                  command has finished.
+
+        """
+        p = self.process
+        while True:
+            channel, length = self._read_message()
+            if channel == b'o':
+                return self._read(length), None
+            elif channel == b'e':
+                err.append(self._read(length))
+            elif channel == b'r':
+                rc, = struct.unpack('>i', self._read(length))
+                return None, rc
+            elif channel in (b'I', b'L'):
+                # no input is ever given, so answer with end of file
+                p.stdin.write(struct.pack('>I', 0))
+                p.stdin.flush()
+            elif channel.isupper():
+                raise ValueError('unsupported hg command server channel')
+            else:
+                self._read(length)
+
+    def _request(self, args):
+        self._send(args)
+        out = []
+        err = []
+        while True:
+            data, rc = self._receive(err)
+            if data is None:
+                return rc, b''.join(out), b''.join(err)
+            out.append(data)
+
+    def _first(self, args, err):
+        self._send(args)
+        return self._receive(err)
+
+    def _retry(self, func, *args):
+        # a dead process is restarted once; any other error leaves the
+        # protocol stream in an unknown state, so the process is dropped
+        try:
+            if self.process is None:
+                self._start()
+            return func(*args)
+        except (IOError, OSError):
+            self._stop()
+            self._start()
+            try:
+                return func(*args)
+            except (IOError, OSError, ValueError):
+                self._stop()
+                raise
+        except ValueError:
+            self._stop()
+            raise
+
+    def _done(self):
+        self.last_used = time.time()
+        self._schedule()
+
+    def __call__(self, args):
+        """Run a Mercurial command
+
+        :param args: The arguments to ``hg`` as a list of bytes.
+        :returns: a tuple of the exit status, stdout and stderr of the
+                  command.
+
+        If the server is busy streaming the output of another command, a
+        separate ``hg`` process is used instead.
+
+        """
+        if not self.lock.acquire(False):
+            p = subprocess.Popen(
+                [HG] + list(args), cwd=self.path,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            stdout, stderr = p.communicate()
+            return p.returncode, stdout, stderr
+        try:
+            result = self._retry(self._request, args)
+            self._done()
+            return result
+        finally:
+            self.lock.release()
+
+    def stream(self, args):
+        """Run a Mercurial command, yielding its output as it arrives
+
+        The server is reserved until iteration finishes. If iteration is
+        stopped early the process is restarted on next use. Otherwise
+        CalledProcessError is raised at the end of iteration if the command
+        failed.
+
+        """
+        if not self.lock.acquire(False):
+            for chunk in command_chunks([HG] + list(args), cwd=self.path):
+                yield chunk
+            return
+        finished = False
+        try:
+            err = []
+            data, rc = self._retry(self._first, args, err)
+            while data is not None:
+                yield data
+                data, rc = self._receive(err)
+            finished = True
+        finally:
+            if finished:
+                self._done()
+            else:
+                self._stop()
+            self.lock.release()
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, [HG] + list(args))
+
+
 class HgRepo(VCSRepo):
     """A Mercurial repository
 
     Valid revisions are anything that Mercurial considers as a revision.
 
+    ``engine`` selects how Mercurial is run. ``'subprocess'`` (the default)
+    starts ``hg`` for every command, while ``'cmdserver'`` sends commands to
+    a long-running :class:`HgCommandServer`. Streamed diffs always use a
+    separate process.
+
+    Parsed manifests of recently used changesets are kept in memory, up to an
+    estimated ``manifest_cache_size`` bytes in total. If ``persist_manifests`` is True they are also stored,
+    compressed, in the private directory.
+
     """
 
+    engines = ('subprocess', 'cmdserver')
+    manifest_cache_size = 64 * 1024 * 1024
+    persist_manifests = False
+
+    def __init__(self, path, encoding='utf-8', engine='subprocess'):
+        super(HgRepo, self).__init__(path, encoding)
+        if engine not in self.engines:
+            raise ValueError('unknown engine: ' + str(engine))
+        self.engine = engine
+        self._manifests = {}
+        self._manifests_order = collections.deque()
+        self._manifests_total = 0
+        self._rev_info = {}
+        self._nodes = {}
+        self._revnums = {}
+        self._symbols = {}
+        self._symbols_state = None
+        self._len_cache = None
+        self._server = None
+        if engine == 'cmdserver':
+            self._server = HgCommandServer(path)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        files_log = self.__dict__.pop('_files_log_v', None)
+        if files_log is not None:
+            files_log.close()
+
     @classmethod
     def clone(cls, srcpath, destpath):
         """Clone an existing repository to a new bare repository."""
@@ -107,12 +604,90 @@ class HgRepo(VCSRepo):
             self._object_cache_v = HashDict(object_cache_path)
             return self._object_cache_v
 
+    @property
+    def _rev_cache(self):
+        try:
+            return self._rev_cache_v
+        except AttributeError:
+            rev_cache_path = os.path.join(self.private_path, 'rev-cache')
+            self._rev_cache_v = HashDict(rev_cache_path)
+            return self._rev_cache_v
+
+    def _state_token(self):
+        """Get a value which changes whenever a symbolic rev may move"""
+        token = []
+        for name in ('store/00changelog.i', 'bookmarks', 'localtags'):
+            try:
+                st = os.stat(os.path.join(self.path, '.hg', name))
+                token.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                token.append(None)
+        return tuple(token)
+
+    def _remember_rev(self, revnum, node):
+        self._nodes[revnum] = node
+        self._revnums[node] = revnum
+        if '%08x' % revnum not in self._rev_cache:
+            self._rev_cache['%08x' % revnum] = node.encode()
+            self._rev_cache[node] = str(revnum).encode()
+
+    def _resolve_rev(self, rev):
+        """Get the revision number and node of a rev
+
+        Revision numbers and nodes never change their meaning, so they are
+        cached for good, in memory and in the private directory. Other revs
+        such as branch names, bookmarks and tags are only cached in memory
+        until the changelog or the bookmarks change.
+
+        """
+        if isinstance(rev, int) and rev >= 0 or (
+            isinstance(rev, str) and rev.isdigit()
+        ):
+            revnum = int(rev)
+            try:
+                return revnum, self._nodes[revnum]
+            except KeyError:
+                pass
+            try:
+                node = self._rev_cache['%08x' % revnum].decode()
+                self._nodes[revnum] = node
+                return revnum, node
+            except KeyError:
+                pass
+        elif isinstance(rev, str) and canonical_rev_rx.match(rev):
+            try:
+                return self._revnums[rev], rev
+            except KeyError:
+                pass
+            try:
+                revnum = int(self._rev_cache[rev])
+                self._revnums[rev] = revnum
+                return revnum, rev
+            except KeyError:
+                pass
+        else:
+            state = self._state_token()
+            if state != self._symbols_state:
+                self._symbols.clear()
+                self._symbols_state = state
+            try:
+                return self._symbols[str(rev)]
+            except KeyError:
+                pass
+        cmd = [HG, 'log', '--template={rev} {node}', '-r', str(rev)]
+        revnum, node = self._command(cmd).decode().split()
+        revnum = int(revnum)
+        if revnum >= 0:
+            self._remember_rev(revnum, node)
+        if not (isinstance(rev, str) and canonical_rev_rx.match(rev)):
+            self._symbols[str(rev)] = revnum, node
+        return revnum, node
+
     def canonical_rev(self, rev):
         if isinstance(rev, str) and canonical_rev_rx.match(rev):
             return rev
         else:
-            cmd = [HG, 'log', '--template={node}', '-r', str(rev)]
-            return self._command(cmd).decode()
+            return self._resolve_rev(rev)[1]
 
     def compose_rev(self, branch, rev):
         return self.canonical_rev(rev)
@@ -123,8 +698,90 @@ class HgRepo(VCSRepo):
         elif isinstance(rev, str) and rev.isdigit():
             return int(rev)
         else:
-            cmd = [HG, 'log', '--template={rev}', '-r', str(rev)]
-            return int(self._command(cmd))
+            return self._resolve_rev(rev)[0]
+
+    @property
+    def _manifest_cache(self):
+        try:
+            return self._manifest_cache_v
+        except AttributeError:
+            manifest_cache_path = os.path.join(self.private_path, 'manifest-cache')
+            self._manifest_cache_v = HashDict(manifest_cache_path)
+            return self._manifest_cache_v
+
+    @property
+    def _files_log(self):
+        try:
+            return self._files_log_v
+        except AttributeError:
+            files_log_path = os.path.join(self.private_path, 'files-log')
+            self._files_log_v = HgFilesLog(files_log_path)
+            return self._files_log_v
+
+    @property
+    def _path_index(self):
+        try:
+            return self._path_index_v
+        except AttributeError:
+            self._path_index_v = HgPathIndex(self.private_path)
+            return self._path_index_v
+
+    def _files_log_entries(self, start):
+        with tempfile.NamedTemporaryFile() as style:
+            style.write((
+                r"changeset = '{rev}\n{node}\n{parents}\n{files}\0'" '\n'
+                r"parent = '{rev} '" '\n'
+                r"file = '{file}\n'" '\n'
+            ).encode())
+            style.flush()
+            # hidden changesets keep their revision numbers, so they are
+            # included to give every revision its own record
+            cmd = [
+                HG, 'log', '--hidden', '--style', style.name,
+                '-r', '%d:' % start,
+            ]
+            for record in self._command_records(cmd, b'\0'):
+                rev, node, parents, files = record.split(b'\n', 3)
+                rev = int(rev)
+                if parents:
+                    parents = [
+                        int(x) for x in parents.split() if x != b'-1']
+                elif rev > 0:
+                    # {parents} is empty when the only parent is the
+                    # previous rev
+                    parents = [rev - 1]
+                else:
+                    parents = []
+                yield rev, node.decode(), parents, files.split(b'\n')[:-1]
+
+    def _manifest(self, rev):
+        node = self.canonical_rev(rev)
+        manifest = self._manifests.get(node)
+        if manifest is not None:
+            self._manifests_order.remove(node)
+            self._manifests_order.append(node)
+            return manifest
+        output = None
+        if self.persist_manifests:
+            try:
+                output = zlib.decompress(self._manifest_cache[node])
+            except KeyError:
+                pass
+        if output is None:
+            cmd = [HG, 'manifest', '--debug', '-r', node]
+            output = self._command(cmd)
+            if self.persist_manifests:
+                self._manifest_cache[node] = zlib.compress(output)
+        manifest = HgManifest(output.decode(self.encoding, 'replace'))
+        if manifest.size > self.manifest_cache_size:
+            return manifest
+        self._manifests[node] = manifest
+        self._manifests_order.append(node)
+        self._manifests_total += manifest.size
+        while self._manifests_total > self.manifest_cache_size:
+            old = self._manifests.pop(self._manifests_order.popleft())
+            self._manifests_total -= old.size
+        return manifest
 
     def _ls(
         self, rev, path, recursive=False, recursive_dirs=False, directory=False
@@ -139,39 +796,36 @@ class HgRepo(VCSRepo):
         else:
             ltrim = len(path) + 1
             prefix = path + '/'
-        cmd = [HG, 'manifest', '--debug', '-r', rev]
-        output = self._command(cmd).decode(self.encoding, 'replace')
-        if not output:
+        manifest = self._manifest(rev)
+        if not manifest:
             return
 
-        dirs = set()
-        exists = False
-        for line in output.splitlines():
-            m = manifest_rx.match(line)
-            assert m, 'unexpected output: ' + line
-            t, name, objid = m.group('type', 'name', 'object')
-            if name.startswith(prefix) or (not forcedir and name == path):
-                if directory and name.startswith(prefix):
-                    yield ('d', path, '', None)
-                    return
-                exists = True
-                entry_name = name[ltrim:]
-                if '/' in entry_name:
-                    p = parent_dirs(entry_name)
-                    if not recursive:
-                        d = next(p)
-                        if d not in dirs:
-                            dirs.add(d)
-                            yield ('d', prefix + d, d, None)
-                        continue
-                    if recursive_dirs:
-                        for d in p:
-                            if d not in dirs:
-                                dirs.add(d)
-                                yield ('d', prefix + d, d, None)
-                yield (t, name, entry_name, objid)
-        if not exists:
+        if not forcedir and path:
+            i = manifest.find(path)
+            if i is not None:
+                name, t, objid = manifest.entries[i]
+                yield (t, name, '', objid)
+                return
+        lo, hi = manifest.span(prefix)
+        if lo == hi:
             raise PathDoesNotExist(rev, path)
+        if directory:
+            yield ('d', path, '', None)
+            return
+        if not recursive:
+            for t, name, objid in manifest.children[path]:
+                yield (t, prefix + name, name, objid)
+            return
+
+        dirs = set()
+        for name, t, objid in manifest.entries[lo:hi]:
+            entry_name = name[ltrim:]
+            if recursive_dirs and '/' in entry_name:
+                for d in parent_dirs(entry_name):
+                    if d not in dirs:
+                        dirs.add(d)
+                        yield ('d', prefix + d, d, None)
+            yield (t, name, entry_name, objid)
 
     def ls(
         self, rev, path, recursive=False, recursive_dirs=False,
@@ -187,37 +841,12 @@ class HgRepo(VCSRepo):
                 return [entry]
 
         if 'commit' in report:
-            import fcntl
-            import tempfile
-            files_cache_path = os.path.join(self.private_path, 'files-cache.log')
-            with open(files_cache_path, 'a+') as files_cache:
-                fcntl.lockf(files_cache, fcntl.LOCK_EX, 0, 0, os.SEEK_CUR)
-                files_cache.seek(0)
-                log = files_cache.read().split('\0')
-                assert log.pop() == ''
-                if log:
-                    startlog = int(log[-1].splitlines()[0]) + 1
-                    if startlog >= len(self):
-                        startlog = None
-                else:
-                    startlog = 0
-                if startlog is not None:
-                    with tempfile.NamedTemporaryFile() as style:
-                        style.write((
-                            r"changeset = '{rev}\n{node}\n{parents}\n{files}\0'" '\n'
-                            r"parent = '{rev} '" '\n'
-                            r"file = '{file|escape}\n'" '\n'
-                        ).encode())
-                        style.flush()
-                        cmd = [HG, 'log', '--style', style.name, '-r', '%d:' % startlog]
-                        output = self._command(cmd).decode(self.encoding, 'replace')
-                        files_cache.write(output)
-                        extend = output.split('\0')
-                        assert extend.pop() == ''
-                        log.extend(extend)
+            log = self._files_log
+            log.update(len(self), self._files_log_entries)
 
         results = []
         lookup_commit = {}
+        lookup_size = []
         for t, fullpath, name, objid in self._ls(revstr, path, recursive, recursive_dirs, directory):
             entry = attrdict(path=fullpath)
             if name:
@@ -229,7 +858,7 @@ class HgRepo(VCSRepo):
                 if 'executable' in report:
                     entry.executable = t == '*'
                 if 'size' in report:
-                    entry.size = len(self._cat(revstr, fullpath))
+                    lookup_size.append((entry, fullpath, objid))
             elif t == '@':
                 entry.type = 'l'
                 if 'target' in report:
@@ -256,40 +885,65 @@ class HgRepo(VCSRepo):
                     lookup_commit[p] = (entry, objid)
             results.append(entry)
 
-        if 'commit' in report:
-            import heapq
-            ancestors = [-self._revnum(revstr)]
-            while ancestors and lookup_commit:
-                r = -heapq.heappop(ancestors)
-                lines = log[r].splitlines()
-                parents = lines[2]
-                if parents:
-                    for x in parents.split():
-                        x = int(x)
-                        if x != -1:
-                            if -x not in ancestors:
-                                heapq.heappush(ancestors, -x)
-                elif r > 0:
-                    x = r - 1
-                    if x not in ancestors:
-                        heapq.heappush(ancestors, -x)
-                for p in list(lookup_commit):
-                    prefix = p.rstrip('/') + '/'
-                    for l in lines[3:]:
-                        if l == p or l.startswith(prefix):
-                            commit = str(lines[1])
-                            entry, objid = lookup_commit[p]
-                            entry.commit = commit
-                            if objid:
-                                import hashlib
-                                concat = (p + objid).encode(self.encoding)
-                                k = hashlib.sha1(concat).hexdigest()
-                                self._object_cache[k] = commit.encode()
-                            del lookup_commit[p]
-                            break
+        if lookup_size:
+            self._sizes(revstr, path, lookup_size)
+
+        if 'commit' in report and lookup_commit:
+            index = self._path_index
+            index.update(log)
+            paths = dict((p.encode(self.encoding), p) for p in lookup_commit)
+            found = index.lookup(self._revnum(revstr), list(paths), log)
+            for key, r in found.items():
+                p = paths[key]
+                commit = log[r][0]
+                entry, objid = lookup_commit[p]
+                entry.commit = commit
+                if objid:
+                    import hashlib
+                    concat = (p + objid).encode(self.encoding)
+                    k = hashlib.sha1(concat).hexdigest()
+                    self._object_cache[k] = commit.encode()
 
         return results
 
+    @property
+    def _size_cache(self):
+        try:
+            return self._size_cache_v
+        except AttributeError:
+            size_cache_path = os.path.join(self.private_path, 'size-cache')
+            self._size_cache_v = HashDict(size_cache_path)
+            return self._size_cache_v
+
+    def _sizes(self, rev, path, entries):
+        """Set the size of many files in a revision
+
+        :param entries: A list of ``(entry, path, filenode)`` tuples.
+
+        Sizes are cached by file node, and all the sizes that are not yet
+        known are listed by a single ``hg files`` call.
+
+        """
+        missing = []
+        for entry, fullpath, objid in entries:
+            try:
+                entry.size = int(self._size_cache[objid])
+            except KeyError:
+                missing.append((entry, fullpath, objid))
+        if not missing:
+            return
+        cmd = [HG, 'files', '-r', rev, '--template={size} {path}\\n']
+        if path:
+            cmd.extend(['--', 'path:' + path.rstrip('/')])
+        output = self._command(cmd).decode(self.encoding, 'replace')
+        sizes = {}
+        for line in output.splitlines():
+            size, name = line.split(' ', 1)
+            sizes[name] = int(size)
+        for entry, fullpath, objid in missing:
+            entry.size = sizes[fullpath]
+            self._size_cache[objid] = str(entry.size).encode()
+
     def _cat(self, rev, path):
         cmd = [HG, 'cat', '-r', rev, path.encode(self.encoding)]
         return self._command(cmd)
@@ -350,6 +1004,8 @@ class HgRepo(VCSRepo):
 
     def __contains__(self, rev):
         cmd = [HG, 'log', '--template=a', '-r', str(rev)]
+        if self._server is not None:
+            return self._server(self._server_args(cmd))[0] == 0
         p = subprocess.Popen(
             cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
@@ -357,16 +1013,20 @@ class HgRepo(VCSRepo):
         return p.returncode == 0
 
     def __len__(self):
+        state = self._state_token()
+        if self._len_cache is not None and self._len_cache[0] == state:
+            return self._len_cache[1]
         cmd = [HG, 'id', '-n', '-r', 'tip']
         output = self._command(cmd)
-        return int(output) + 1
+        self._len_cache = state, int(output) + 1
+        return self._len_cache[1]
 
-    def log(
+    def iter_log(
         self, revrange=None, limit=None, firstparent=False, merges=None,
         path=None, follow=False
     ):
         cmd = [
-            HG, 'log', '--debug', '--template={node}\\0{parents}\\0'
+            HG, 'log', '--debug', '--template={rev}\\0{node}\\0{parents}\\0'
             '{date|hgdate}\\0{author|nonempty}'
             '\\0{desc|tabindent|nonempty}\\0\\0']
         if limit is not None:
@@ -378,7 +1038,6 @@ class HgRepo(VCSRepo):
                 cmd.append('--only-merges')
             else:
                 cmd.append('--no-merges')
-        single = False
         if revrange is None:
             pass
         elif isinstance(revrange, (tuple, list)):
@@ -396,20 +1055,16 @@ class HgRepo(VCSRepo):
             entry = self._commit_cache.get(self.canonical_rev(revrange))
             if entry:
                 entry._cached = True
-                return entry
+                yield entry
+                return
             cmd.extend(['-r', str(revrange)])
-            single = True
         if path:
             if follow:
                 cmd.append('--follow')
             cmd.extend(['--', type(self).cleanPath(path)])
-        output = self._command(cmd).decode(self.encoding, 'replace')
-
-        results = []
-        logs = output.split('\0\0')
-        logs.pop()
-        for log in logs:
-            rev, parents, date, author, message = log.split('\0', 4)
+        for log in self._command_records(cmd, b'\0\0'):
+            log = log.decode(self.encoding, 'replace')
+            revnum, rev, parents, date, author, message = log.split('\0', 5)
             parents = [
                 x[1] for x in filter(
                     lambda x: x[0] != '-1',
@@ -417,14 +1072,12 @@ class HgRepo(VCSRepo):
                 )
             ]
             date = parse_hgdate(date)
+            self._rev_info[int(revnum)] = rev, date
             message = message.replace('\n\t', '\n')
             entry = CommitLogEntry(rev, parents, date, author, message)
             if rev not in self._commit_cache:
                 self._commit_cache[rev] = entry
-            if single:
-                return entry
-            results.append(entry)
-        return results
+            yield entry
 
     def changed(self, rev):
         cmd = [HG, 'status', '-C', '--change', str(rev)]
@@ -446,12 +1099,35 @@ class HgRepo(VCSRepo):
         cmd = [HG, 'log', '--template=a', '-p', '-r', str(rev)]
         return self._command(cmd)[1:].decode(self.encoding)
 
+    def pdiff_stream(self, rev, out=None, max_bytes=None):
+        cmd = [HG, 'log', '--template=a', '-p', '-r', str(rev)]
+        chunks = _skip_bytes(self._command_chunks(cmd), 1)
+        return self._write_chunks(chunks, out, max_bytes)
+
     def diff(self, rev_a, rev_b, path=None):
         cmd = [HG, 'diff', '-r', rev_a, '-r', rev_b]
         if path is not None:
             cmd.extend(['--', type(self).cleanPath(path)])
         return self._command(cmd).decode(self.encoding)
 
+    def diff_stream(self, rev_a, rev_b, path=None, out=None, max_bytes=None):
+        cmd = [HG, 'diff', '-r', rev_a, '-r', rev_b]
+        if path is not None:
+            cmd.extend(['--', type(self).cleanPath(path)])
+        return self._write_chunks(self._command_chunks(cmd), out, max_bytes)
+
+    def pstat(self, rev):
+        cmd = [HG, 'log', '--template=a', '-p', '--git', '-r', str(rev)]
+        chunks = _skip_bytes(self._command_chunks(cmd), 1)
+        return list(parse_diffstat(chunks, self.encoding))
+
+    def diffstat(self, rev_a, rev_b, path=None):
+        cmd = [HG, 'diff', '--git', '-r', rev_a, '-r', rev_b]
+        if path is not None:
+            cmd.extend(['--', type(self).cleanPath(path)])
+        chunks = self._command_chunks(cmd)
+        return list(parse_diffstat(chunks, self.encoding))
+
     def ancestor(self, rev1, rev2):
         cmd = [HG, 'log', '--template={node}', '-r', 'ancestor(%s, %s)' % (rev1, rev2)]
         output = self._command(cmd).decode()
@@ -460,24 +1136,36 @@ class HgRepo(VCSRepo):
         else:
             return output
 
+    def _resolve_revs(self, revnums):
+        """Get the node and date of many revision numbers at once
+
+        Results are remembered in :attr:`_rev_info`, which :meth:`log` also
+        fills in.
+
+        """
+        missing = sorted(set(r for r in revnums if r not in self._rev_info))
+        if missing:
+            cmd = [HG, 'log', '--template={rev}\\0{node}\\0{date|hgdate}\\0\\0']
+            for r in missing:
+                cmd.extend(['-r', str(r)])
+            for record in self._command_records(cmd, b'\0\0'):
+                revnum, node, date = record.decode().split('\0')
+                self._rev_info[int(revnum)] = node, parse_hgdate(date)
+        return self._rev_info
+
     def _blame(self, rev, path):
         cmd = [HG, 'annotate', '-unv', '-r', rev, '--', path]
         output = self._command(cmd).decode(self.encoding, 'replace')
-        revs = {}
-        results = []
+        lines = []
         cat = self._cat(rev, path)
         for line, text in zip(output.splitlines(), cat.splitlines()):
             m = annotate_rx.match(line)
             assert m, 'unexpected output: ' + line
-            rev, author = m.group('rev', 'author')
-            try:
-                rev, date = revs[rev]
-            except KeyError:
-                cmd = [HG, 'log', '--template={node}\n{date|hgdate}', '-r', rev]
-                output = self._command(cmd).decode(self.encoding, 'replace')
-                rev, date = output.split('\n', 1)
-                date = parse_hgdate(date)
-                revs[rev] = rev, date
+            lines.append((int(m.group('rev')), m.group('author'), text))
+        info = self._resolve_revs(set(x[0] for x in lines))
+        results = []
+        for revnum, author, text in lines:
+            rev, date = info[revnum]
             results.append(BlameInfo(rev, author, date, text))
         return results
 
@@ -492,4 +1180,32 @@ class HgRepo(VCSRepo):
     def tip(self, head):
         return self.canonical_rev(head)
 
+    def _server_args(self, cmd):
+        fsencoding = sys.getfilesystemencoding()
+        return [
+            x if isinstance(x, bytes) else x.encode(fsencoding)
+            for x in cmd[1:]
+        ]
+
+    def _command(self, cmd, input=None, **kwargs):
+        if self._server is None or kwargs or input is not None:
+            return super(HgRepo, self)._command(cmd, input, **kwargs)
+        rc, stdout, stderr = self._server(self._server_args(cmd))
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, cmd)
+        return stdout
+
+    def _command_records(self, cmd, stop, **kwargs):
+        if self._server is None or kwargs:
+            return super(HgRepo, self)._command_records(cmd, stop, **kwargs)
+        return self._server_records(cmd, stop)
+
+    def _server_records(self, cmd, stop):
+        chunks = self._server.stream(self._server_args(cmd))
+        try:
+            for record in iter_records(chunks, stop):
+                yield record
+        finally:
+            chunks.close()
+
 # vi:set tabstop=4 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,168 @@
+# Copyright (c) 2013-2014, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import tempfile
+from .hashdict import HashDict
+
+
+class PathIndex(object):
+    """An on-disk index from paths to lists of fixed-size records.
+
+    Records are appended to the list for each path in the order they are
+    added, and are read back newest first. Paths may be given as str or bytes.
+    The index is multi-process safe.
+    """
+
+    def __init__(self, path, recsize, mode=0o666, bufsize=8192):
+        self.store = HashDict(path, mode)
+        self.recsize = recsize
+        self.bufsize = bufsize - bufsize % recsize
+
+    def _key(self, path):
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return hashlib.sha1(path).hexdigest()
+
+    def extend(self, records):
+        """Append records to the index
+
+        :param records: A mapping from path to a list of records.
+
+        """
+        for path, recs in records.items():
+            self.store.append(self._key(path), b''.join(recs))
+
+    def reversed(self, path):
+        """Iterate over the records of path, newest first"""
+        key = self._key(path)
+        p = os.path.join(self.store.path, key[:2], key[2:])
+        try:
+            f = open(p, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            fcntl.lockf(f, fcntl.LOCK_SH)
+            end = os.fstat(f.fileno()).st_size
+            end -= end % self.recsize
+            while end > 0:
+                start = max(0, end - self.bufsize)
+                f.seek(start)
+                buf = f.read(end - start)
+                for i in range(len(buf) - self.recsize, -1, -self.recsize):
+                    yield buf[i:i + self.recsize]
+                end = start
+
+
+def with_parents(paths):
+    """Get a set of paths and all of their parent directories, as bytes"""
+    names = set()
+    for name in paths:
+        names.add(name)
+        d = name.rfind(b'/')
+        while d != -1:
+            name = name[:d]
+            names.add(name)
+            d = name.rfind(b'/')
+    return names
+
+
+class RevisionIndex(object):
+    """An on-disk index from paths to the revision numbers that changed them
+
+    Revisions are added in order. The number of revisions indexed so far is
+    kept next to the index, so it can be extended as new revisions arrive.
+    """
+
+    flush_interval = 1000
+
+    def __init__(self, path):
+        self.paths = PathIndex(path, 4)
+        self.count_path = path + '.count'
+        self.lock_path = path + '.lock'
+
+    def count(self):
+        """Get the number of revisions indexed"""
+        try:
+            with open(self.count_path, 'rb') as f:
+                return int(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def _set_count(self, count):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.count_path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(str(count).encode())
+        os.rename(tmp, self.count_path)
+
+    def update(self, count, fetch):
+        """Make sure the first count revisions are indexed
+
+        :param fetch: A function which is given the first revision which is
+                      not indexed yet and returns an iterable of ``(rev,
+                      keys)`` for it and every later revision, where the
+                      keys are bytes, e.g. from :func:`with_parents`.
+
+        """
+        if self.count() >= count:
+            return
+        with open(self.lock_path, 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            start = self.count()
+            if start >= count:
+                return
+            postings = {}
+            for rev, keys in fetch(start):
+                posting = struct.pack('>I', rev)
+                for key in keys:
+                    postings.setdefault(key, []).append(posting)
+                if (rev + 1) % self.flush_interval == 0:
+                    # the postings are written before the count, so that a
+                    # revision is not considered indexed until they are
+                    self.paths.extend(postings)
+                    postings.clear()
+                    self._set_count(rev + 1)
+                if rev + 1 >= count:
+                    break
+            self.paths.extend(postings)
+            self._set_count(count)
+
+    def revisions(self, path):
+        """Iterate over the revisions that changed path, newest first"""
+        for posting in self.paths.reversed(path):
+            yield struct.unpack('>I', posting)[0]
+
+# vi:set tabstop=4 softtabstop=4 shiftwidth=4 expandtab:
@@ -26,6 +26,7 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import calendar
 import difflib
 import collections
 import fnmatch
@@ -34,7 +35,15 @@ import re
 import subprocess
 import sys
 import errno
+import xml.etree.ElementTree as ET
 from .common import *
+from .hashdict import HashDict
+from .pathindex import RevisionIndex, with_parents
+
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
 
 DIFF = 'diff'
 SVN = 'svn'
@@ -45,16 +54,8 @@ BINARY_DIFF = """\
 Binary files {fromfile} and {tofile} differ
 """
 
-#
-# Using the ASCII codec here should be OK as long as Subversion never includes
-# unicode characters in their numbering scheme.
-#
-SVN_VERSION = tuple(
-    command([SVN, '--version', '--quiet'])
-        .decode()
-        .strip()
-        .split('.')
-)
+_svn_version = None
+_svnlook_version = None
 
 head_rev_rx = re.compile(r'^(?=.)(?P<head>\D[^:]*)?:?(?P<rev>\d+)?$')
 mergeinfo_rx = re.compile(r'^(?P<head>.+):(?P<minrev>\d+)(?:-(?P<maxrev>\d+))$')
@@ -74,6 +75,126 @@ def _add_diff_prefix(diff, a='a', b='b'):
     return output
 
 
+def _add_diff_prefix_chunks(chunks, a=b'a', b=b'b'):
+    lines = iter_lines(chunks)
+    try:
+        for line in lines:
+            if line.startswith(b'--- '):
+                line = b'--- ' + a + b'/' + line[4:]
+            if line.startswith(b'+++ '):
+                line = b'+++ ' + b + b'/' + line[4:]
+            yield line
+    finally:
+        lines.close()
+
+
+def svnlook_version():
+    """Get the version of svnlook as a tuple of integers
+
+    svnlook is only run the first time this is called.
+
+    """
+    global _svnlook_version
+    if _svnlook_version is None:
+        # Using the ASCII codec here should be OK as long as Subversion never
+        # includes unicode characters in their numbering scheme.
+        output = command([SVNLOOK, '--version', '--quiet']).decode().strip()
+        _svnlook_version = tuple(
+            int(x) for x in re.match(r'[\d.]*\d', output).group().split('.')
+        )
+    return _svnlook_version
+
+
+def svn_version():
+    """Get the version of svn as a tuple of strings
+
+    svn is only run the first time this is called.
+
+    """
+    global _svn_version
+    if _svn_version is None:
+        # Using the ASCII codec here should be OK as long as Subversion never
+        # includes unicode characters in their numbering scheme.
+        output = command([SVN, '--version', '--quiet']).decode().strip()
+        _svn_version = tuple(output.split('.'))
+    return _svn_version
+
+
+def _localtime(dt):
+    """Convert an aware datetime to the local timezone, as svnlook prints it"""
+    ts = calendar.timegm(dt.utctimetuple())
+    offset = (datetime.datetime.fromtimestamp(ts) -
+              datetime.datetime.utcfromtimestamp(ts))
+    return dt.astimezone(UTCOffset(offset))
+
+
+class _ChunkReader(object):
+    """Minimal file-like wrapper so ElementTree can parse a chunk stream"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def read(self, size=-1):
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
+
+
+class _LazyVersion(object):
+    """A version tuple that is only computed when it is first used
+
+    Instances behave like the tuple returned by the given function, so they
+    can be indexed, iterated and compared against ordinary tuples.
+
+    """
+
+    def __init__(self, func):
+        self._func = func
+
+    def __getitem__(self, index):
+        return self._func()[index]
+
+    def __len__(self):
+        return len(self._func())
+
+    def __iter__(self):
+        return iter(self._func())
+
+    def __contains__(self, item):
+        return item in self._func()
+
+    def __hash__(self):
+        return hash(self._func())
+
+    def __eq__(self, other):
+        return self._func() == tuple(other)
+
+    def __ne__(self, other):
+        return self._func() != tuple(other)
+
+    def __lt__(self, other):
+        return self._func() < tuple(other)
+
+    def __le__(self, other):
+        return self._func() <= tuple(other)
+
+    def __gt__(self, other):
+        return self._func() > tuple(other)
+
+    def __ge__(self, other):
+        return self._func() >= tuple(other)
+
+    def __repr__(self):
+        return repr(self._func())
+
+
+# SVN_VERSION used to be computed when this module was imported. It still
+# behaves like the svn client's version as a tuple of strings, but svn is only
+# run the first time it is used.
+SVN_VERSION = _LazyVersion(svn_version)
+
+
 def _join(*args):
     return '/'.join(arg for arg in args if arg)
 
@@ -185,11 +306,51 @@ class SvnRepo(VCSRepo):
         #
         # Subversion 1.8 adds extra user output when given a path argument.
         #
-        if not path is None and SVN_VERSION >= ('1', '8'):
+        if not path is None and svnlook_version() >= (1, 8):
             return props[1:]
         else:
             return props
 
+    def _file_url(self, path):
+        url = 'file://' + os.path.abspath(self.path) + path
+        if not isinstance(url, bytes):
+            url = url.encode('utf-8')
+        return quote(url, safe=b'/:')
+
+    def _bulk_proplist(self, rev, path, recursive=False):
+        """List the properties of a path and of everything below it
+
+        :returns: A dictionary from paths without a leading slash to lists of
+                  property names, with only the paths that have properties,
+                  or None if ``svn`` could not be run.
+
+        """
+        url = self._file_url(path)
+        cmd = [
+            SVN, 'proplist', '--xml', '--non-interactive',
+            '--depth', 'infinity' if recursive else 'immediates',
+            '%s@%s' % (url, rev),
+        ]
+        try:
+            output = self._command(cmd, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        base = unquote(self._file_url('/'))
+        if isinstance(base, bytes):
+            base = base.decode('utf-8', 'replace')
+        results = {}
+        for target in ET.fromstring(output).findall('target'):
+            name = target.get('path')
+            if name.startswith('file://'):
+                name = unquote(name)
+                if isinstance(name, bytes):
+                    name = name.decode('utf-8', 'replace')
+                name = name[len(base):]
+            results[name.strip('/')] = [
+                x.get('name') for x in target.findall('property')
+            ]
+        return results
+
     def proplist(self, rev, path=None):
         """List Subversion properties of the path"""
         rev, prefix = self._maprev(rev)
@@ -276,7 +437,7 @@ class SvnRepo(VCSRepo):
             if directory:
                 entry = attrdict(path='/', type='d')
                 if 'commit' in report:
-                    entry.commit = self._history(revstr, '/', 1)[0].rev
+                    entry.commit = self._last_changed(rev, '/')
                 return [entry]
             ltrim = 1
             prefix = '/'
@@ -287,6 +448,8 @@ class SvnRepo(VCSRepo):
         cmd = [SVNLOOK, 'tree', '-r', revstr, '--full-paths']
         if not recursive:
             cmd.append('--non-recursive')
+        if 'size' in report:
+            cmd.append('--show-ids')
         cmd.extend(['.', path])
         p = subprocess.Popen(
             cmd, cwd=self.path, stdout=subprocess.PIPE,
@@ -301,6 +464,12 @@ class SvnRepo(VCSRepo):
 
         results = []
         lines = output.decode(self.encoding, 'replace').splitlines()
+        ids = {}
+        if 'size' in report:
+            for i, line in enumerate(lines):
+                name, nodeid = line.rsplit(' <', 1)
+                ids[name] = nodeid.rstrip('>')
+                lines[i] = name
         if forcedir and not lines[0].endswith('/'):
             raise PathDoesNotExist(rev, path)
         if lines[0].endswith('/'):
@@ -308,6 +477,11 @@ class SvnRepo(VCSRepo):
                 lines = lines[:1]
             else:
                 lines = lines[1:]
+        props = None
+        if len([x for x in lines if not x.endswith('/')]) > 1:
+            # one svn process for the whole listing instead of one per file
+            props = self._bulk_proplist(revstr, path, recursive)
+        lookup_size = []
         for name in lines:
             entry_name = name[ltrim:]
             entry = attrdict(path=name.strip('/'))
@@ -317,7 +491,10 @@ class SvnRepo(VCSRepo):
                 entry.type = 'd'
                 entry_name = entry_name.rstrip('/')
             else:
-                proplist = self._proplist(revstr, name)
+                if props is None:
+                    proplist = self._proplist(revstr, name)
+                else:
+                    proplist = props.get(name.strip('/'), [])
                 if 'svn:special' in proplist:
                     link = self._cat(revstr, name).decode(self.encoding, 'replace')
                     link = link.split(None, 1)
@@ -330,14 +507,134 @@ class SvnRepo(VCSRepo):
                     if 'executable' in report:
                         entry.executable = 'svn:executable' in proplist
                     if 'size' in report:
-                        entry.size = len(self._cat(revstr, name))
+                        lookup_size.append((entry, name, ids[name]))
             if entry_name:
                 entry.name = entry_name
             if 'commit' in report:
-                entry.commit = self._history(revstr, name, 1)[0].rev
+                entry.commit = self._last_changed(rev, name)
             results.append(entry)
+        if lookup_size:
+            self._sizes(revstr, path, recursive, lookup_size)
         return results
 
+    @property
+    def _changed_index(self):
+        try:
+            return self._changed_index_v
+        except AttributeError:
+            changed_index_path = os.path.join(self.private_path, 'changed-revs')
+            self._changed_index_v = RevisionIndex(changed_index_path)
+            return self._changed_index_v
+
+    def _changed_keys(self, start):
+        # Every revision changes the root. Copies are also recorded under
+        # the copied path prefixed with a NUL, because they change every
+        # path below the copy without listing them.
+        for rev in range(start, self.youngest() + 1):
+            paths = []
+            copies = []
+            if rev > 0:
+                cmd = [SVNLOOK, 'changed', '.', '-r', str(rev), '--copy-info']
+                for line in self._command(cmd).splitlines():
+                    if line.startswith(b' '):
+                        # the "(from path:rN)" line following a copy
+                        continue
+                    path = line[4:].strip(b'/')
+                    paths.append(path)
+                    if line[2:3] == b'+':
+                        copies.append(b'\0' + path)
+            yield rev, with_parents(paths) | set(copies) | set([b''])
+
+    def _last_changed(self, rev, path):
+        """Find the last revision up to rev in which path changed
+
+        This is the revision ``svnlook history`` lists first, looked up in an
+        index of the paths changed by each revision.
+
+        """
+        index = self._changed_index
+        index.update(rev + 1, self._changed_keys)
+        path = path.strip('/').encode(self.encoding)
+        keys = [path]
+        prefix = path
+        while prefix:
+            keys.append(b'\0' + prefix)
+            prefix = prefix[:max(prefix.rfind(b'/'), 0)]
+        best = None
+        for key in keys:
+            for r in index.revisions(key):
+                if r <= rev:
+                    if best is None or r > best:
+                        best = r
+                    break
+        if best is None:
+            path = '/' + path.decode(self.encoding)
+            return self._history(str(rev), path, 1)[0].rev
+        return best
+
+    @property
+    def _size_cache(self):
+        try:
+            return self._size_cache_v
+        except AttributeError:
+            size_cache_path = os.path.join(self.private_path, 'size-cache')
+            self._size_cache_v = HashDict(size_cache_path)
+            return self._size_cache_v
+
+    def _sizes(self, rev, path, recursive, entries):
+        """Set the size of many files in a listing
+
+        :param entries: A list of ``(entry, path, node revision id)`` tuples.
+
+        Sizes are cached by node revision id. If several sizes are not known
+        yet then they are all listed by a single ``svn list`` call.
+
+        """
+        missing = []
+        for entry, name, nodeid in entries:
+            key = hashlib.sha1(nodeid.encode()).hexdigest()
+            try:
+                entry.size = int(self._size_cache[key])
+            except KeyError:
+                missing.append((entry, name, key))
+        sizes = {}
+        if len(missing) > 1:
+            sizes = self._bulk_sizes(rev, path, recursive) or {}
+        for entry, name, key in missing:
+            try:
+                entry.size = sizes[name.strip('/')]
+            except KeyError:
+                entry.size = self._filesize(rev, name)
+            self._size_cache[key] = str(entry.size).encode()
+
+    def _bulk_sizes(self, rev, path, recursive=False):
+        url = self._file_url(path)
+        cmd = [
+            SVN, 'list', '--xml', '--non-interactive',
+            '--depth', 'infinity' if recursive else 'immediates',
+            '%s@%s' % (url, rev),
+        ]
+        try:
+            output = self._command(cmd, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        prefix = path.strip('/')
+        results = {}
+        for entry in ET.fromstring(output).findall('list/entry'):
+            if entry.get('kind') != 'file':
+                continue
+            name = _join(prefix, entry.findtext('name'))
+            results[name] = int(entry.findtext('size'))
+        return results
+
+    def _filesize(self, rev, path):
+        cmd = [SVNLOOK, 'filesize', '-r', rev, '.', path.encode(self.encoding)]
+        try:
+            return int(self._command(cmd, stderr=subprocess.PIPE))
+        except subprocess.CalledProcessError:
+            # svnlook filesize was added in Subversion 1.9
+            return len(self._cat(rev, path))
+
     def _cat(self, rev, path):
         cmd = [SVNLOOK, 'cat', '-r', rev, '.', path.encode(self.encoding)]
         return self._command(cmd)
@@ -424,7 +721,7 @@ class SvnRepo(VCSRepo):
         output = self._command(cmd)
         return len(output.splitlines()) - 3
 
-    def log(
+    def iter_log(
         self, revrange=None, limit=None, firstparent=False, merges=None,
         path=None, follow=False
     ):
@@ -433,10 +730,11 @@ class SvnRepo(VCSRepo):
             rev, prefix = self._maprev(revrange)
             h = self._history(rev, prefix, 1)
             rev = h[0].rev
-            return self._logentry(rev, prefix)
+            yield self._logentry(rev, prefix)
+            return
 
         if revrange is None:
-            results = self._history(self.youngest(), path or '/', limit)
+            entries = self._iter_log_page(self.youngest(), path or '/', limit)
         else:
             if revrange[1] is None:
                 include = set()
@@ -468,16 +766,117 @@ class SvnRepo(VCSRepo):
                 results = include - exclude
 
             results = sorted(results, key=lambda x: x.rev, reverse=True)
+            entries = self._iter_log_range(results)
 
-        results = map(lambda x: self._logentry(x.rev, x.path), results)
-        if merges is not None:
-            if merges:
-                results = filter(lambda x: len(x.parents) > 1, results)
-            else:
-                results = filter(lambda x: len(x.parents) <= 1, results)
-        return list(results)
+        for entry in entries:
+            if merges is not None and (len(entry.parents) > 1) != bool(merges):
+                continue
+            yield entry
+
+    def _iter_log_page(self, rev, path, limit=None):
+        """Log the history of a path using one ``svn log`` call
+
+        Authors, dates, messages and changed paths come from a single
+        ``svn log --xml -v`` stream instead of an ``svnlook info`` per
+        revision; revisions missing from it fall back to svnlook.
+
+        """
+        history = self._iter_history(
+            rev, path, None if limit is None else limit + 1)
+        infos = self._iter_bulk_log(rev, path, limit)
+        try:
+            info = next(infos, None)
+            nxt = next(history, None)
+            count = 0
+            while nxt is not None and (limit is None or count < limit):
+                x, nxt = nxt, next(history, None)
+                while info is not None and info[0] > x.rev:
+                    info = next(infos, None)
+                h = [x] if nxt is None else [x, nxt]
+                if info is not None and info[0] == x.rev:
+                    yield self._logentry(x.rev, x.path, h, info)
+                else:
+                    yield self._logentry(x.rev, x.path, h)
+                count += 1
+        finally:
+            infos.close()
+            history.close()
+
+    def _iter_log_range(self, results):
+        """Log the given history entries using one ``svn log`` call
+
+        ``results`` must be sorted newest first. Their authors, dates,
+        messages and changed paths are read from a single ``svn log --xml
+        -v`` stream over the whole span; revisions missing from it fall back
+        to svnlook.
+
+        """
+        if not results:
+            return
+        infos = self._iter_bulk_log(
+            results[0].rev, '/', minrev=results[-1].rev)
+        try:
+            info = next(infos, None)
+            for x in results:
+                while info is not None and info[0] > x.rev:
+                    info = next(infos, None)
+                if info is not None and info[0] == x.rev:
+                    yield self._logentry(x.rev, x.path, info=info)
+                else:
+                    yield self._logentry(x.rev, x.path)
+        finally:
+            infos.close()
+
+    def _iter_bulk_log(self, rev, path, limit=None, minrev=0):
+        """Parse ``svn log --xml -v`` incrementally
+
+        :returns: An iterator of ``(rev, author, date, message, changed)``
+                  tuples, newest first, where ``changed`` maps each changed
+                  path to its ``(action, prop-mods)`` attributes. If ``svn``
+                  fails before any entry is read the iterator is empty, so
+                  the caller falls back to svnlook; a later failure is
+                  raised rather than truncating the log.
+
+        """
+        cmd = [
+            SVN, 'log', '--xml', '-v', '--non-interactive',
+            '-r', '%d:%d' % (rev, minrev),
+        ]
+        if limit is not None:
+            cmd.extend(['-l', str(limit)])
+        cmd.append('%s@%d' % (self._file_url(path), rev))
+        devnull = open(os.devnull, 'wb')
+        chunks = self._command_chunks(cmd, stderr=devnull)
+        started = False
+        try:
+            for event, elem in ET.iterparse(_ChunkReader(chunks)):
+                if elem.tag != 'logentry':
+                    continue
+                changed = {}
+                for p in elem.findall('paths/path'):
+                    name = (p.text or '').rstrip('/') or '/'
+                    changed[name] = (p.get('action'), p.get('prop-mods'))
+                date = elem.findtext('date')
+                date = _localtime(parse_isodate(date)).replace(microsecond=0)
+                entry = (
+                    int(elem.get('revision')),
+                    elem.findtext('author') or '',
+                    date,
+                    (elem.findtext('msg') or '') + '\n',
+                    changed,
+                )
+                elem.clear()
+                started = True
+                yield entry
+        except (OSError, SyntaxError, ValueError, TypeError, AssertionError,
+                subprocess.CalledProcessError):
+            if started:
+                raise
+        finally:
+            chunks.close()
+            devnull.close()
 
-    def _logentry(self, rev, path, history=None):
+    def _logentry(self, rev, path, history=None, info=None):
         import hashlib
         revstr = str(rev)
         cmd = [SVNLOOK, 'info', '.', '-r', revstr]
@@ -486,9 +885,17 @@ class SvnRepo(VCSRepo):
         if entry:
             entry._cached = True
             return entry
-        output = self._command(cmd).decode(self.encoding, 'replace')
-        author, date, logsize, message = output.split('\n', 3)
-        date = parse_isodate(date)
+        if info is None:
+            output = self._command(cmd).decode(self.encoding, 'replace')
+            author, date, logsize, message = output.split('\n', 3)
+            date = parse_isodate(date)
+            propmods = True
+        else:
+            author, date, message, changed = info[1:]
+            # mergeinfo can only add parents in a revision that sets it,
+            # i.e. one that adds the path or modifies its properties
+            action, mods = changed.get(path.rstrip('/') or '/', ('M', 'false'))
+            propmods = action != 'M' or mods != 'false'
         if history is None:
             history = self._history(rev, path, 2)
         parents = []
@@ -498,7 +905,8 @@ class SvnRepo(VCSRepo):
                 parents.append(prev)
             else:
                 parents.append('%s:%d' % (path, prev))
-            for head, minrev, maxrev in self._mergeinfo(rev, path):
+            for head, minrev, maxrev in (
+                    self._mergeinfo(rev, path) if propmods else ()):
                 if prev < maxrev:
                     h = self._history(maxrev, head, 1)
                     if head == '/':
@@ -518,6 +926,14 @@ class SvnRepo(VCSRepo):
         output = self._command(cmd)
         return _add_diff_prefix(output.decode(self.encoding))
 
+    def pdiff_stream(self, rev, out=None, max_bytes=None):
+        rev, prefix = self._maprev(rev)
+        if rev == 0:
+            return self._write_chunks([], out, max_bytes)
+        cmd = [SVNLOOK, 'diff', '.', '-r', str(rev)]
+        chunks = _add_diff_prefix_chunks(self._command_chunks(cmd))
+        return self._write_chunks(chunks, out, max_bytes)
+
     def _compose_url(self, rev=None, path=None, proto='file'):
         url = '%s://%s' % (proto, self.path)
         rev, prefix = self._maprev(rev)
@@ -607,6 +1023,19 @@ class SvnRepo(VCSRepo):
     def diff(self, rev_a, rev_b, path=None):
         return self._diff(rev_a, rev_b, path)
 
+    def diff_stream(self, rev_a, rev_b, path=None, out=None, max_bytes=None):
+        if path and not (
+            self._exists(rev_a, path) and self._exists(rev_b, path)
+        ):
+            # added or removed paths are diffed in Python
+            chunks = [self._diff(rev_a, rev_b, path).encode(self.encoding)]
+        else:
+            url_a = self._compose_url(rev=rev_a, path=path)
+            url_b = self._compose_url(rev=rev_b, path=path)
+            cmd = [SVN, 'diff', url_a, url_b]
+            chunks = _add_diff_prefix_chunks(self._command_chunks(cmd))
+        return self._write_chunks(chunks, out, max_bytes)
+
     def changed(self, rev):
         rev, prefix = self._maprev(rev)
         if rev == 0:
@@ -630,16 +1059,19 @@ class SvnRepo(VCSRepo):
             results.append(entry)
         return results
 
-    def _history(self, rev, path, limit=None):
+    def _iter_history(self, rev, path, limit=None):
         cmd = [SVNLOOK, 'history', '.', '-r', str(rev), path]
         if limit is not None:
             cmd.extend(['-l', str(limit)])
-        output = self._command(cmd).decode(self.encoding, 'replace')
-        results = []
-        for line in output.splitlines()[2:]:
-            r, p = line.split(None, 1)
-            results.append(HistoryEntry(int(r), p))
-        return results
+        lines = self._command_records(cmd, b'\n')
+        for i, line in enumerate(lines):
+            if i < 2:
+                continue
+            r, p = line.decode(self.encoding, 'replace').split(None, 1)
+            yield HistoryEntry(int(r), p)
+
+    def _history(self, rev, path, limit=None):
+        return list(self._iter_history(rev, path, limit))
 
     def _mergehistory(self, rev, path, limit=None):
         results = set(self._history(rev, path, limit))
@@ -28,6 +28,7 @@
 
 import anyvcs
 import datetime
+import io
 import os
 import re
 import shutil
@@ -879,6 +880,19 @@ class BasicTest(object):
         self.assertEqual(self.rev1, result.rev)
         self.assertIsInstance(result.date, datetime.datetime)
 
+    def test_iter_log(self):
+        result = self.repo.iter_log(revrange=(None, self.main_branch))
+        self.assertNotIsInstance(result, list)
+        entry = next(result)
+        self.assertIsInstance(entry, CommitLogEntry)
+        self.assertEqual(self.rev1, entry.rev)
+        self.assertRaises(StopIteration, next, result)
+
+    def test_iter_log_rev(self):
+        result = list(self.repo.iter_log(revrange=self.rev1))
+        self.assertEqual(1, len(result))
+        self.assertEqual(self.rev1, result[0].rev)
+
     def test_in(self):
         self.assertIn(self.rev1, self.repo)
 
@@ -936,6 +950,23 @@ class BasicTest(object):
         rc = subprocess.call(['diff', '-urN', path_a, path_b])
         self.assertEqual(0, rc)
 
+    def test_pdiff_stream(self):
+        correct = self.repo.pdiff(self.rev1).encode(self.repo.encoding)
+        result = b''.join(self.repo.pdiff_stream(self.rev1))
+        self.assertEqual(correct, result)
+        result = b''.join(self.repo.pdiff_stream(self.rev1, max_bytes=10))
+        self.assertEqual(correct[:10], result)
+        out = io.BytesIO()
+        count = self.repo.pdiff_stream(self.rev1, out=out)
+        self.assertEqual(len(correct), count)
+        self.assertEqual(correct, out.getvalue())
+
+    def test_pstat(self):
+        result = self.repo.pstat(self.rev1)
+        self.assertEqual(4, len(result))
+        for stat in result:
+            self.assertEqual((1, 0, False), tuple(stat))
+
     def test_canonical_rev(self):
         result = self.repo.canonical_rev(self.working_head)
         self.assertEqual(self.rev1, result)
@@ -1353,6 +1384,32 @@ class BranchTestStep7(object):
         rc = subprocess.call(['diff', '-urN', path_a, path_b])
         self.assertEqual(0, rc)
 
+    def test_diff_stream(self):
+        branch1a = self.encode_branch('branch1a')
+        correct = self.repo.diff(self.main_branch, branch1a)
+        correct = correct.encode(self.repo.encoding)
+        result = self.repo.diff_stream(self.main_branch, branch1a)
+        self.assertEqual(correct, b''.join(result))
+        result = self.repo.diff_stream(self.main_branch, branch1a, max_bytes=0)
+        self.assertEqual(b'', b''.join(result))
+        correct = self.repo.diff(self.main_branch, branch1a, '/b')
+        correct = correct.encode(self.repo.encoding)
+        out = io.BytesIO()
+        self.repo.diff_stream(self.main_branch, branch1a, '/b', out=out)
+        self.assertEqual(correct, out.getvalue())
+
+    def test_diffstat(self):
+        branch1a = self.encode_branch('branch1a')
+        diff = self.repo.diff(self.main_branch, branch1a)
+        result = self.repo.diffstat(self.main_branch, branch1a)
+        added = sum(x.added for x in result)
+        deleted = sum(x.deleted for x in result)
+        lines = diff.splitlines()
+        correct = len([x for x in lines if x.startswith('+')]) - len(result)
+        self.assertEqual(correct, added)
+        correct = len([x for x in lines if x.startswith('-')]) - len(result)
+        self.assertEqual(correct, deleted)
+
     def test_changed_rev2(self):
         branch_prefix = self.branch_prefix(self.main_branch)
         result = self.repo.changed(self.rev[2])
@@ -1729,6 +1786,18 @@ class BranchTestStep13(object):
         correct = self.rev[15]
         self.assertEqual(correct, result)
 
+    def test_changed_many(self):
+        def normalize(changes):
+            return sorted((x.path, x.status, x.copy) for x in changes)
+        revs = [x.rev for x in self.repo.log(revrange=(None, self.main_branch))]
+        revs.append(revs[-1])
+        result = list(self.repo.changed_many(revs))
+        self.assertEqual(revs, [rev for rev, changes in result])
+        for rev, changes in result:
+            self.assertEqual(normalize(self.repo.changed(rev)), normalize(changes))
+        result = list(self.repo.changed_range((None, self.main_branch), limit=2))
+        self.assertEqual(revs[:2], [rev for rev, changes in result])
+
 
 class GitLikeBranchTestStep13(BranchTestStep13):
     def test_branches(self):
@@ -0,0 +1,232 @@
+# Copyright (c) 2013-2014, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+if sys.hexversion < 0x02070000:
+    import unittest2 as unittest
+else:
+    import unittest
+from anyvcs.common import RecordReader, command_records, parse_diffstat
+from anyvcs.hashdict import HashDict
+from anyvcs.pathindex import RevisionIndex, with_parents
+
+
+class RecordReaderTest(unittest.TestCase):
+    def records(self, data, stop, bufsize):
+        reader = RecordReader(io.BytesIO(data), bufsize)
+        return list(reader.records(stop))
+
+    def test_records(self):
+        data = b'alpha\0beta\0\0gamma'
+        correct = [b'alpha', b'beta', b'', b'gamma']
+        for bufsize in (1, 2, 3, 64):
+            self.assertEqual(correct, self.records(data, b'\0', bufsize))
+            self.assertEqual(correct, self.records(data + b'\0', b'\0', bufsize))
+
+    def test_records_multibyte(self):
+        data = b'a\0b\0\0c\0\0'
+        for bufsize in (1, 2, 3, 64):
+            result = self.records(data, b'\0\0', bufsize)
+            self.assertEqual([b'a\0b', b'c'], result)
+
+    def test_mixed_delimiters(self):
+        reader = RecordReader(io.BytesIO(b'header\nx\0y\0'), 4)
+        self.assertEqual(b'header', reader.readuntil(b'\n'))
+        self.assertEqual([b'x', b'y'], list(reader.records(b'\0')))
+        self.assertIsNone(reader.readuntil(b'\0'))
+
+    def test_command_records(self):
+        records = command_records(['printf', 'a\\nb\\n'], b'\n')
+        self.assertEqual([b'a', b'b'], list(records))
+
+    def test_command_records_stop(self):
+        records = command_records(['yes'], b'\n', bufsize=16)
+        self.assertEqual(b'y', next(records))
+        records.close()
+
+
+class DiffStatTest(unittest.TestCase):
+    def stats(self, diff):
+        return [(x.path,) + tuple(x) for x in parse_diffstat([diff])]
+
+    def test_git(self):
+        diff = (
+            b'diff --git a/x y b/x y\n'
+            b'index 1..2 100644\n'
+            b'--- a/x y\t\n'
+            b'+++ b/x y\t\n'
+            b'@@ -1,3 +1,2 @@\n'
+            b' one\n'
+            b'--- two\n'
+            b'-three\n'
+            b'+++ three\n'
+            b'\\ No newline at end of file\n'
+            b'diff --git a/z b/z\n'
+            b'new file mode 100644\n'
+            b'index 0..3\n'
+            b'Binary files /dev/null and b/z differ\n'
+            b'diff --git a/gone b/gone\n'
+            b'deleted file mode 100644\n'
+            b'--- a/gone\n'
+            b'+++ /dev/null\n'
+            b'@@ -1 +0,0 @@\n'
+            b'-bye\n'
+        )
+        correct = [
+            ('x y', 1, 2, False),
+            ('z', 0, 0, True),
+            ('gone', 0, 1, False),
+        ]
+        self.assertEqual(correct, self.stats(diff))
+
+    def test_svn(self):
+        # as printed by svnlook diff
+        diff = (
+            b'Modified: trunk/a\n'
+            b'===================================================================\n'
+            b'--- trunk/a\t2014-01-01 00:00:00 UTC (rev 1)\n'
+            b'+++ trunk/a\t2014-01-01 00:00:00 UTC (rev 2)\n'
+            b'@@ -1 +1,2 @@\n'
+            b'-x\n'
+            b'+y\n'
+            b'+z\n'
+            b'\n'
+            b'Added: trunk/b\n'
+            b'===================================================================\n'
+            b'(Binary files differ)\n'
+            b'\n'
+            b'\n'
+            b'Property changes on: trunk/b\n'
+            b'___________________________________________________________________\n'
+            b'Added: svn:mime-type\n'
+            b'## -0,0 +1 ##\n'
+            b'+application/octet-stream\n'
+            b'\\ No newline at end of property\n'
+        )
+        correct = [
+            ('trunk/a', 2, 1, False),
+            ('trunk/b', 0, 0, True),
+        ]
+        self.assertEqual(correct, self.stats(diff))
+
+    def test_svn_client(self):
+        diff = (
+            b'Index: trunk/b\n'
+            b'===================================================================\n'
+            b'Cannot display: file marked as a binary type.\n'
+            b'svn:mime-type = application/octet-stream\n'
+        )
+        self.assertEqual([('trunk/b', 0, 0, True)], self.stats(diff))
+
+
+class HashDictTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='anyvcs-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append(self):
+        d = HashDict(os.path.join(self.dir, 'dict'), mode=0o600)
+        key = '0123' * 10
+        d.append(key, b'a')
+        d.append(key, b'b')
+        self.assertEqual(b'ab', d[key])
+        path = os.path.join(self.dir, 'dict', key[:2], key[2:])
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+
+class RevisionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='anyvcs-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_with_parents(self):
+        correct = set([b'a', b'a/b', b'a/b/c', b'd'])
+        self.assertEqual(correct, with_parents([b'a/b/c', b'd', b'a/b']))
+
+    def test_update(self):
+        changes = [[b'a'], [b'b/c'], [], [b'a', b'b/d']]
+        fetched = []
+
+        def fetch(start):
+            fetched.append(start)
+            for rev in range(start, len(changes)):
+                yield rev, with_parents(changes[rev])
+
+        index = RevisionIndex(os.path.join(self.dir, 'index'))
+        index.flush_interval = 2
+        index.update(2, fetch)
+        self.assertEqual(2, index.count())
+        index.update(2, fetch)
+        index.update(4, fetch)
+        self.assertEqual([0, 2], fetched)
+        self.assertEqual([3, 0], list(index.revisions(b'a')))
+        self.assertEqual([3, 1], list(index.revisions(b'b')))
+        self.assertEqual([1], list(index.revisions(b'b/c')))
+        self.assertEqual([], list(index.revisions(b'x')))
+
+
+class ImportTest(unittest.TestCase):
+    code = """
+import subprocess
+import sys
+def fail(*args, **kwargs):
+    raise AssertionError('subprocess started: %r' % (args,))
+subprocess.Popen = fail
+import anyvcs, anyvcs.git, anyvcs.hg, anyvcs.svn
+for vcs in ('git', 'hg', 'svn'):
+    anyvcs.open(sys.argv[1], vcs).close()
+"""
+
+    def test_no_subprocess(self):
+        path = tempfile.mkdtemp(prefix='anyvcs-test.')
+        try:
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env = dict(os.environ)
+            pythonpath = [root, env.get('PYTHONPATH')]
+            env['PYTHONPATH'] = os.pathsep.join(x for x in pythonpath if x)
+            cmd = [sys.executable, '-c', self.code, path]
+            p = subprocess.Popen(cmd, env=env, stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+            self.assertEqual(0, p.returncode, stderr.decode())
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vi:set tabstop=4 softtabstop=4 shiftwidth=4 expandtab:
@@ -29,8 +29,12 @@
 import common
 import anyvcs
 
+import hashlib
 import os
+import shutil
 import subprocess
+import tempfile
+import time
 
 
 class GitTest(common.VCSTest):
@@ -166,5 +170,353 @@ class GitEmptyCommitTest(GitTest, common.EmptyCommitTest):
     pass
 
 
+class GitCatFileTest(GitTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        with open(os.path.join(working_path, 'a'), 'w') as f:
+            f.write('Pisgah')
+        os.symlink('a', os.path.join(working_path, 'b'))
+        os.mkdir(os.path.join(working_path, 'c'))
+        with open(os.path.join(working_path, 'c', 'd'), 'w') as f:
+            f.write('Denali')
+        os.chmod(os.path.join(working_path, 'c', 'd'), 0o755)
+        with open(os.path.join(working_path, 'x y'), 'w') as f:
+            f.write('Rainier')
+        yield common.Commit('commit 1')
+
+    def test_cat_restart(self):
+        self.assertEqual(b'Pisgah', self.repo.cat(self.main_branch, 'a'))
+        process = self.repo._cat_file.process
+        process.kill()
+        process.wait()
+        self.assertEqual(b'Pisgah', self.repo.cat(self.main_branch, 'a'))
+        self.assertEqual('a', self.repo.readlink(self.main_branch, 'b'))
+
+    def test_stat(self):
+        result = self.repo.stat(self.main_branch, '/a')
+        self.assertEqual('f', result.type)
+        self.assertEqual(6, result.size)
+        self.assertEqual(False, result.executable)
+        self.assertEqual(40, len(result.object))
+        result = self.repo.stat(self.main_branch, 'c/d')
+        self.assertEqual(('f', True), (result.type, result.executable))
+        self.assertEqual('l', self.repo.stat(self.main_branch, 'b').type)
+        self.assertEqual('d', self.repo.stat(self.main_branch, 'c/').type)
+        self.assertEqual('d', self.repo.stat(self.main_branch, '/').type)
+
+    def test_stat_error(self):
+        self.assertRaises(common.PathDoesNotExist, self.repo.stat, self.main_branch, '/z')
+        self.assertRaises(common.PathDoesNotExist, self.repo.stat, self.main_branch, '/a/')
+
+    def test_space(self):
+        self.assertEqual(b'Rainier', self.repo.cat(self.main_branch, 'x y'))
+        self.assertEqual(7, self.repo.stat(self.main_branch, 'x y').size)
+        self.assertRaises(common.PathDoesNotExist, self.repo.stat, self.main_branch, 'x z')
+        self.assertRaises(common.PathDoesNotExist, self.repo.cat, self.main_branch, 'x z')
+
+    def test_close(self):
+        with anyvcs.open(self.main_path) as repo:
+            self.assertEqual(b'Pisgah', repo.cat(self.main_branch, 'a'))
+            process = repo._cat_file.process
+            self.assertIsNone(process.poll())
+        self.assertIsNone(repo._cat_file.process)
+        self.assertIsNotNone(process.poll())
+
+
+class GitLastCommitIndexTest(GitTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        os.mkdir(os.path.join(working_path, 'c'))
+        common.touch(os.path.join(working_path, 'c', 'a'), 'a1')
+        common.touch(os.path.join(working_path, 'c', 'b'), 'b1')
+        yield common.Commit('commit 1')
+        cls.rev1 = cls.getAbsoluteRev()
+        common.touch(os.path.join(working_path, 'c', 'a'), 'a2')
+        yield common.Commit('commit 2')
+        cls.rev2 = cls.getAbsoluteRev()
+
+    def ls_commits(self, rev):
+        result = self.repo.ls(rev, '/c', report=['commit'])
+        return dict((x.name, x.commit) for x in result)
+
+    def test_ls_commit(self):
+        correct = {'a': self.rev2, 'b': self.rev1}
+        self.assertEqual(correct, self.ls_commits(self.rev2))
+        correct = {'a': self.rev1, 'b': self.rev1}
+        self.assertEqual(correct, self.ls_commits(self.rev1))
+        result = self.repo.ls(self.rev2, '/c', directory=True, report=['commit'])
+        self.assertEqual(self.rev2, result[0].commit)
+        index = os.path.join(self.repo.private_path, 'path-commits')
+        self.assertTrue(os.path.isdir(index))
+
+
+class GitRefsTest(GitTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        common.touch(os.path.join(working_path, 'a'), 'a1')
+        yield common.Commit('commit 1')
+        cls.rev1 = cls.getAbsoluteRev()
+        common.touch(os.path.join(working_path, 'a'), 'a2')
+        yield common.Commit('commit 2')
+        cls.rev2 = cls.getAbsoluteRev()
+
+    def git(self, *args):
+        cmd = [
+            'git', '-c', 'user.name=Test User', '-c', 'user.email=me@example.com'
+        ] + list(args)
+        return common.check_output(cmd, cwd=self.main_path).decode().strip()
+
+    def test_refs(self):
+        self.assertTrue(self.repo._refs.supported)
+        self.git('branch', 'b1', self.rev1)
+        self.git('tag', 't1', self.rev1)
+        self.git('tag', '-a', '-m', 'annotated', 't2', self.rev2)
+        self.git('pack-refs', '--all')
+        self.git('branch', 'b2', self.rev2)
+        self.assertEqual(['b1', 'b2', 'master'], self.repo.branches())
+        self.assertEqual(['t1', 't2'], self.repo.tags())
+        for rev in ('HEAD', 'master', 'b1', 't1', 't2', 'refs/heads/b1', 'tags/t2', 'master~1'):
+            self.assertEqual(self.git('rev-parse', rev), self.repo.canonical_rev(rev))
+        self.assertEqual(self.rev2, self.repo._refs.peel(b'refs/tags/t2'))
+        # loose refs override packed refs, and changes invalidate the cache
+        self.git('update-ref', 'refs/heads/b1', self.rev2)
+        self.git('branch', '-D', 'b2')
+        self.assertEqual(self.rev2, self.repo.canonical_rev('b1'))
+        self.assertEqual(['b1', 'master'], self.repo.branches())
+
+    def test_fingerprint(self):
+        refs = self.repo._refs
+        self.git('branch', 'f1', self.rev1)
+        # pretend nothing has changed for a while
+        old = time.time() - 10
+        paths = [os.path.join(self.main_path, 'HEAD')]
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.main_path, 'refs')):
+            paths.append(dirpath)
+            paths.extend(os.path.join(dirpath, x) for x in filenames)
+        for path in paths:
+            os.utime(path, (old, old))
+        key = refs.fingerprint()
+        self.assertIsNotNone(refs._quick)
+        self.assertEqual(key, refs.fingerprint())
+        self.git('update-ref', 'refs/heads/f1', self.rev2)
+        self.assertNotEqual(key, refs.fingerprint())
+        self.assertEqual(self.rev2, self.repo.canonical_rev('f1'))
+        self.git('branch', '-D', 'f1')
+
+    def test_len(self):
+        self.assertEqual(2, len(self.repo))
+        self.assertEqual(2, len(self.repo))
+        tree = self.git('rev-parse', self.rev2 + '^{tree}')
+        rev3 = self.git('commit-tree', tree, '-p', self.rev2, '-m', 'commit 3')
+        self.assertEqual(2, len(self.repo))
+        self.git('update-ref', 'refs/test/b3', rev3)
+        self.assertEqual(3, len(self.repo))
+
+    def test_len_non_bare(self):
+        with anyvcs.open(self.working_path, 'git') as repo:
+            self.assertTrue(repo._refs.supported)
+            count = len(repo)
+            self.assertEqual(count, len(repo))
+            self.check_call(['git', 'commit', '--allow-empty', '-m', 'commit 4'])
+            self.assertEqual(count + 1, len(repo))
+
+
+class GitNativeTest(GitTest):
+    @classmethod
+    def setUpRepos(cls):
+        super(GitNativeTest, cls).setUpRepos()
+        cls.repo = anyvcs.open(cls.main_path, 'git', engine='native')
+
+
+class GitNativeBasicTest(GitNativeTest, common.GitLikeBasicTest):
+    pass
+
+
+class GitNativeBranchTestStep7(GitNativeTest, common.GitLikeBranchTestStep7):
+    pass
+
+
+class GitNativeBranchTestStep13(GitNativeTest, GitBranchTestStep13):
+    pass
+
+
+class GitObjectStoreTest(GitNativeTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        lines = ['line %d\n' % i for i in range(2000)]
+        for i in range(5):
+            lines[i * 100] = 'changed %d\n' % i
+            common.touch(os.path.join(working_path, 'a'), ''.join(lines))
+            common.touch(os.path.join(working_path, 'b%d' % i), str(i))
+            yield common.Commit('commit %d' % i)
+
+    def check_objects(self):
+        from anyvcs.git import GitCatFile
+        cmd = ['git', 'cat-file', '--batch-all-objects', '--batch-check=%(objectname)']
+        shas = common.check_output(cmd, cwd=self.main_path).decode().split()
+        self.assertTrue(shas)
+        cat_file = GitCatFile(self.main_path)
+        try:
+            for sha in shas:
+                obj = cat_file(sha.encode())
+                correct = (obj.type, obj.size, obj.data)
+                self.assertEqual(correct, self.repo._store.read(sha))
+                correct = (obj.type, obj.size, None)
+                self.assertEqual(correct, self.repo._store.read(sha, True))
+        finally:
+            cat_file.close()
+
+    def test_objects(self):
+        self.check_objects()
+        common.check_call(['git', 'gc', '--quiet', '--aggressive'], cwd=self.main_path)
+        self.check_objects()
+        self.assertEqual(b'4', self.repo.cat(self.main_branch, 'b4'))
+        result = self.repo.log(revrange=self.main_branch)
+        correct = self.repo.log(revrange=(None, self.main_branch))[0]
+        for attr in ('rev', 'parents', 'date', 'author', 'message'):
+            self.assertEqual(getattr(correct, attr), getattr(result, attr))
+        self.assertIsNone(self.repo._cat_file.fallback.process)
+        self.assertIsNone(self.repo._store.read('0' * 40))
+
+    def test_deep_delta_chain(self):
+        from anyvcs.gitstore import ObjectStore
+        path = tempfile.mkdtemp(prefix='anyvcs-test.')
+        try:
+            common.check_call(['git', 'init', '-q', '--bare', path])
+            # fast-import stores each blob as a delta of the previous one,
+            # making a chain deeper than Python's recursion limit
+            stream = []
+            lines = []
+            for i in range(1200):
+                lines.append('line %d\n' % i)
+                data = ''.join(lines).encode()
+                stream.append(('blob\ndata %d\n' % len(data)).encode() + data + b'\n')
+            cmd = ['git', 'fast-import', '--quiet', '--depth=2000']
+            p = subprocess.Popen(cmd, cwd=path, stdin=subprocess.PIPE)
+            p.communicate(b''.join(stream))
+            self.assertEqual(0, p.returncode)
+            sha = hashlib.sha1(('blob %d\0' % len(data)).encode() + data).hexdigest()
+            store = ObjectStore(path)
+            try:
+                self.assertEqual(('blob', len(data), data), store.read(sha))
+                self.assertEqual(('blob', len(data), None), store.read(sha, True))
+            finally:
+                store.close()
+        finally:
+            shutil.rmtree(path)
+
+
+class GitCommitGraphTest(GitTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        common.touch(os.path.join(working_path, 'a'), '1')
+        yield common.Commit('commit 1')
+        yield common.CreateBranch('b1')
+        common.touch(os.path.join(working_path, 'b'), '3')
+        yield common.Commit('commit 3')
+        yield common.SwitchBranch('master')
+        common.touch(os.path.join(working_path, 'a'), '2')
+        yield common.Commit('commit 2')
+        yield common.Merge('b1')
+        yield common.SwitchBranch('b1')
+        yield common.Merge('master~1')
+        yield common.CreateTag('t1')
+        yield common.CreateBranch('b2')
+        common.touch(os.path.join(working_path, 'c'), '4')
+        yield common.Commit('commit 4')
+
+    def git(self, *args):
+        p = subprocess.Popen(
+            ['git'] + list(args), cwd=self.main_path, stdout=subprocess.PIPE
+        )
+        stdout, stderr = p.communicate()
+        return p.returncode, stdout.decode().split()
+
+    def check_graph(self, repo):
+        revs = self.git('rev-list', '--all')[1] + ['t1']
+        pairs = [(x, y) for x in revs for y in revs]
+        bases = repo.ancestor_many(pairs)
+        for (x, y), base in zip(pairs, bases):
+            self.assertEqual(
+                self.git('merge-base', '--is-ancestor', x, y)[0] == 0,
+                repo.is_ancestor(x, y)
+            )
+            self.assertIn(base, self.git('merge-base', '--all', x, y)[1])
+        self.assertEqual(self.git('merge-base', 'master', 'b1')[1][0], repo.ancestor('master', 'b1'))
+
+    def test_commit_graph(self):
+        self.check_graph(self.repo)
+        graph = os.path.join(self.repo.private_path, 'commit-graph')
+        self.assertTrue(os.path.isfile(graph))
+        self.assertIn(self.repo.canonical_rev('b2'), self.repo)
+        # now with git's own commit-graph file
+        self.git('commit-graph', 'write', '--reachable')
+        with anyvcs.open(self.main_path, 'git') as repo:
+            self.check_graph(repo)
+            self.assertIsNotNone(repo._commit_graphs[0])
+
+    def test_non_bare(self):
+        with anyvcs.open(self.working_path, 'git') as repo:
+            self.check_graph(repo)
+            graph = os.path.join(repo.private_path, 'commit-graph')
+            self.assertTrue(os.path.isfile(graph))
+            # a new commit changes the refs, so the graph is rebuilt
+            self.check_call(['git', 'commit', '--allow-empty', '-m', 'commit 5'])
+            rev = self.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+            self.assertTrue(repo.is_ancestor('HEAD~1', rev))
+            self.assertIsNotNone(repo._find_in_graph([rev])[0])
+        self.check_call(['git', 'commit-graph', 'write', '--reachable'])
+        with anyvcs.open(self.working_path, 'git') as repo:
+            self.assertIsNotNone(repo._commit_graphs[0])
+            self.check_graph(repo)
+
+    def test_pruned(self):
+        tree = self.git('rev-parse', 'master^{tree}')[1][0]
+        rev = self.git(
+            '-c', 'user.name=Test User', '-c', 'user.email=me@example.com',
+            'commit-tree', tree, '-p', 'master', '-m', 'pruned'
+        )[1][0]
+        self.git('update-ref', 'refs/heads/pruned', rev)
+        self.assertTrue(self.repo.is_ancestor('master', rev))
+        self.assertIn(rev, self.repo)
+        self.git('update-ref', '-d', 'refs/heads/pruned')
+        self.git('reflog', 'expire', '--expire=now', '--all')
+        self.git('gc', '--prune=now', '--quiet')
+        self.assertIsNotNone(self.repo._find_in_graph([rev])[0])
+        self.assertNotIn(rev, self.repo)
+
+
+class GitBlameTest(GitTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        lines = ['line %d\n' % i for i in range(10)]
+        common.touch(os.path.join(working_path, 'a'), ''.join(lines))
+        yield common.Commit('commit 1')
+        cls.rev1 = cls.getAbsoluteRev()
+        lines[2] = 'changed 2\r\n'
+        lines[7] = 'changed 7\n'
+        common.touch(os.path.join(working_path, 'a'), ''.join(lines))
+        yield common.Commit('commit 2')
+        cls.rev2 = cls.getAbsoluteRev()
+
+    def test_blame(self):
+        correct = [self.rev1] * 10
+        correct[2] = correct[7] = self.rev2
+        result = self.repo.iter_blame(self.main_branch, 'a')
+        self.assertNotIsInstance(result, list)
+        result = list(result)
+        self.assertEqual(correct, [x.rev for x in result])
+        self.assertEqual(b'changed 2', result[2].line)
+        self.assertEqual(b'line 9', result[9].line)
+        cache = os.path.join(self.repo.private_path, 'blame-cache')
+        self.assertTrue(os.listdir(cache))
+        cached = self.repo.blame(self.main_branch, 'a')
+        for attr in ('rev', 'author', 'date', 'line'):
+            self.assertEqual(
+                [getattr(x, attr) for x in result],
+                [getattr(x, attr) for x in cached]
+            )
+
+
 if __name__ == "__main__":
     common.unittest.main()
@@ -30,7 +30,10 @@ import common
 import anyvcs
 
 import os
+import shutil
 import subprocess
+import tempfile
+import time
 
 
 class HgTest(common.VCSTest):
@@ -123,6 +126,14 @@ class HgBasicTest(HgTest, common.GitLikeBasicTest):
         correct = ['rev0', 'default', 'tip']
         self.assertEqual(common.normalize_heads(correct), common.normalize_heads(result))
 
+    def test_rev_cache(self):
+        self.assertEqual(self.rev1, self.repo.canonical_rev('default'))
+        self.assertEqual(0, self.repo._revnum('default'))
+        repo = anyvcs.open(self.main_path, 'hg')
+        self.assertEqual(self.rev1.encode(), repo._rev_cache['%08x' % 0])
+        self.assertEqual(self.rev1, repo.canonical_rev(0))
+        self.assertEqual(0, repo._revnum(self.rev1))
+
 
 class HgUnrelatedBranchTest(HgTest, common.UnrelatedBranchTest):
     pass
@@ -177,5 +188,184 @@ class HgCopyTest(HgTest, common.CopyTest):
     pass
 
 
+class HgManifestTest(common.unittest.TestCase):
+    def test_manifest(self):
+        from anyvcs.hg import HgManifest
+        names = ['b/d/e', 'a', 'b/c', 'b0', 'b/d/f', 'bc']
+        output = ''.join(
+            '%040x 644   %s\n' % (i, name) for i, name in enumerate(names)
+        )
+        manifest = HgManifest(output)
+        self.assertEqual(sorted(names), manifest.names)
+        self.assertEqual(0, manifest.find('a'))
+        self.assertIsNone(manifest.find('b'))
+        self.assertEqual((1, 4), manifest.span('b/'))
+        self.assertEqual((2, 4), manifest.span('b/d/'))
+        self.assertEqual((0, 6), manifest.span(''))
+        lo, hi = manifest.span('c/')
+        self.assertEqual(lo, hi)
+        children = [(t, name) for t, name, objid in manifest.children['']]
+        self.assertEqual(
+            [(' ', 'a'), ('d', 'b'), (' ', 'b0'), (' ', 'bc')], children)
+        children = [(t, name) for t, name, objid in manifest.children['b']]
+        self.assertEqual([(' ', 'c'), ('d', 'd')], children)
+
+    def test_cache_eviction(self):
+        from anyvcs.hg import HgManifest, HgRepo
+        outputs = {}
+        for rev in range(4):
+            outputs[str(rev)] = ''.join(
+                '%040x 644   f%d\n' % (i, i) for i in range(10 * (rev + 1))
+            ).encode()
+        repo = HgRepo(tempfile.gettempdir())
+        repo.canonical_rev = lambda rev: rev
+        repo._command = lambda cmd: outputs[cmd[-1]]
+        sizes = [len(repo._manifest(str(rev))) for rev in range(3)]
+        self.assertEqual([10, 20, 30], sizes)
+        self.assertEqual(['0', '1', '2'], list(repo._manifests_order))
+        total = sum(x.size for x in repo._manifests.values())
+        self.assertEqual(total, repo._manifests_total)
+        # make room for the newest manifest only
+        repo.manifest_cache_size = HgManifest(outputs['3'].decode()).size + 1
+        repo._manifest('3')
+        self.assertEqual(['3'], list(repo._manifests_order))
+        repo._manifest('0')
+        self.assertEqual(['0'], list(repo._manifests_order))
+        self.assertEqual(repo._manifests['0'].size, repo._manifests_total)
+
+
+class HgFilesLogTest(common.unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='anyvcs-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, start):
+        for rev in range(start, 4):
+            files = [('f%d' % rev).encode(), b'd/g'] if rev % 2 else []
+            yield rev, '%040x' % rev, [rev - 1] if rev else [], files
+
+    def test_update(self):
+        from anyvcs.hg import HgFilesLog
+        path = os.path.join(self.dir, 'files-log')
+        log = HgFilesLog(path)
+        self.assertEqual(0, len(log))
+        log.update(2, self.fetch)
+        self.assertEqual(4, len(log))
+        self.assertEqual(('%040x' % 0, [], []), log[0])
+        self.assertEqual(('%040x' % 1, [0], [b'f1', b'd/g']), log[1])
+        other = HgFilesLog(path)
+        self.assertEqual(4, len(other))
+        self.assertEqual(log[3], other[3])
+        # a record without a table entry is dropped by the next writer
+        with open(path + '.dat', 'ab') as f:
+            f.write(b'partial')
+        other.update(5, lambda start: [(start, 'f' * 40, [1, 2], [b'h'])])
+        self.assertEqual(('f' * 40, [1, 2], [b'h']), other[4])
+        self.assertEqual(log[3], other[3])
+        log.close()
+        other.close()
+
+    def test_gaps(self):
+        from anyvcs.hg import HgFilesLog
+        log = HgFilesLog(os.path.join(self.dir, 'files-log'))
+        records = [(0, 'a' * 40, [], [b'x']), (2, 'b' * 40, [0], [b'y'])]
+        log.update(3, lambda start: records)
+        self.assertEqual(3, len(log))
+        self.assertEqual(('0' * 40, [], []), log[1])
+        self.assertEqual(('b' * 40, [0], [b'y']), log[2])
+        self.assertRaises(
+            ValueError, log.update, 5, lambda start: [(start - 1, 'c' * 40, [], [])])
+        log.close()
+
+
+class HgPathIndexTest(common.unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='anyvcs-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        from anyvcs.hg import HgFilesLog, HgPathIndex
+        #   0 - 1 - 3
+        #    \- 2 -/
+        records = [
+            (0, '%040x' % 0, [], [b'a', b'd/e']),
+            (1, '%040x' % 1, [0], [b'd/e']),
+            (2, '%040x' % 2, [0], [b'a', b'd/f']),
+            (3, '%040x' % 3, [1, 2], []),
+        ]
+        log = HgFilesLog(os.path.join(self.dir, 'files-log'))
+        log.update(3, lambda start: records[start:])
+        index = HgPathIndex(self.dir)
+        index.update(log)
+        paths = [b'a', b'd', b'd/e', b'd/f', b'x']
+        correct = {b'a': 0, b'd': 1, b'd/e': 1}
+        self.assertEqual(correct, index.lookup(1, paths, log))
+        correct = {b'a': 2, b'd': 2, b'd/e': 0, b'd/f': 2}
+        self.assertEqual(correct, index.lookup(2, paths, log))
+        correct = {b'a': 2, b'd': 2, b'd/e': 1, b'd/f': 2}
+        self.assertEqual(correct, index.lookup(3, paths, log))
+        log.close()
+
+
+class HgCmdServerTest(HgTest):
+    @classmethod
+    def setUpRepos(cls):
+        super(HgCmdServerTest, cls).setUpRepos()
+        cls.repo = anyvcs.open(cls.main_path, 'hg', engine='cmdserver')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.repo.close()
+        super(HgCmdServerTest, cls).tearDownClass()
+
+
+class HgCmdServerBasicTest(HgCmdServerTest, HgBasicTest):
+    def test_restart(self):
+        server = self.repo._server
+        self.assertEqual(self.rev1, self.repo.canonical_rev('default'))
+        server.process.kill()
+        server.process.wait()
+        self.assertEqual(self.rev1, self.repo.canonical_rev('default'))
+        self.repo.close()
+        self.assertIsNone(server.process)
+        self.assertEqual(self.rev1, self.repo.canonical_rev('default'))
+
+    def test_stream(self):
+        server = self.repo._server
+        args = [b'log', b'--template={node}\n', b'-r', b'default']
+        chunks = server.stream(args)
+        output = next(chunks)
+        # the server is busy, so this runs in a separate process
+        rc, out, err = server(args)
+        self.assertEqual((0, self.rev1 + '\n'), (rc, out.decode()))
+        output += b''.join(chunks)
+        self.assertEqual(self.rev1 + '\n', output.decode())
+        records = self.repo._command_records(['hg'] + args, b'\n')
+        self.assertEqual([self.rev1.encode()], list(records))
+
+    def test_idle_timeout(self):
+        from anyvcs.hg import HgCommandServer
+        server = HgCommandServer(self.main_path, idle_timeout=0.1)
+        rc, out, err = server([b'log', b'--template={node}', b'-r', b'default'])
+        self.assertEqual(0, rc)
+        self.assertEqual(self.rev1, out.decode())
+        self.assertIsNotNone(server.process)
+        time.sleep(0.5)
+        self.assertIsNone(server.process)
+        server.close()
+
+
+class HgCmdServerBranchTestStep7(HgCmdServerTest, HgBranchTestStep7):
+    pass
+
+
+class HgCmdServerBranchTestStep13(HgCmdServerTest, HgBranchTestStep13):
+    pass
+
+
 if __name__ == "__main__":
     common.unittest.main()
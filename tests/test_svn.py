@@ -95,6 +95,16 @@ class SvnTest(common.VCSTest):
         return 'branches/' + branch + '/'
 
 
+class SvnVersionTest(common.unittest.TestCase):
+    def test_svn_version(self):
+        from anyvcs import svn
+        version = tuple(int(x) for x in svn.SVN_VERSION[:2])
+        self.assertEqual(svn.svnlook_version()[:2], version)
+        self.assertEqual(svn.svn_version(), tuple(svn.SVN_VERSION))
+        self.assertEqual(svn.SVN_VERSION, svn.svn_version())
+        self.assertTrue(svn.SVN_VERSION >= ('1',))
+
+
 class SvnEmptyTest(SvnTest, common.EmptyTest):
     def test_branches(self):
         result = self.repo.branches()
@@ -259,6 +269,23 @@ class SvnBranchTestStep3(SvnTest, common.BranchTestStep3):
         correct = list(range(4, 2, -1))
         self.assertEqual(correct, result)
 
+    def test_log_range_bulk(self):
+        branch1 = self.encode_branch('branch1')
+        repo = anyvcs.open(self.main_path, 'svn')
+        repo._commit_cache_v = {}
+        commands = []
+        command = repo._command
+
+        def record(cmd, *args, **kwargs):
+            commands.append(cmd)
+            return command(cmd, *args, **kwargs)
+        repo._command = record
+        result = [x.rev for x in repo.log(revrange=(None, branch1))]
+        correct = list(range(4, 0, -1))
+        self.assertEqual(correct, result)
+        info = [cmd for cmd in commands if cmd[:2] == ['svnlook', 'info']]
+        self.assertEqual([], info)
+
 class SvnBranchTestStep7(SvnTest, common.BranchTestStep7):
     def test_branches(self):
         result = self.repo.branches()
@@ -533,5 +560,37 @@ class SvnHeadRevTest(SvnTest):
         self.assertTrue(len(diff) > 0)
 
 
+class SvnLastChangedCopyTest(SvnTest):
+    @classmethod
+    def setUpWorkingCopy(cls, working_path):
+        yield common.CreateStandardDirectoryStructure()
+        os.makedirs(os.path.join(working_path, 'a'))
+        common.touch(os.path.join(working_path, 'a', 'b'), 'b1')
+        common.touch(os.path.join(working_path, 'c'), 'c1')
+        yield common.Commit('create a/b and c')
+        common.touch(os.path.join(working_path, 'c'), 'c2')
+        yield common.Commit('change c')
+        yield common.CreateBranch('branch1')
+        common.touch(os.path.join(working_path, 'c'), 'c3')
+        yield common.Commit('change c on branch1')
+        cls.rev1 = cls.getAbsoluteRev()
+
+    def svnlook_history(self, rev, path):
+        cmd = ['svnlook', 'history', '-r', str(rev), '-l', '1', '.', path]
+        output = common.check_output(cmd, cwd=self.main_path).decode()
+        return int(output.splitlines()[2].split()[0])
+
+    def test_ls_commit(self):
+        rev = int(self.rev1.rsplit(':', 1)[1])
+        result = self.repo.ls(self.rev1, '/', recursive=True, report=['commit'])
+        self.assertEqual(3, len(result))
+        for entry in result:
+            correct = self.svnlook_history(rev, '/' + entry.path.lstrip('/'))
+            self.assertEqual(correct, entry.commit)
+        # a and a/b were last changed by copying trunk to the branch
+        commits = dict((x.name, x.commit) for x in result)
+        self.assertEqual(commits['a'], rev - 1)
+
+
 if __name__ == "__main__":
     common.unittest.main()